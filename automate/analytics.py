@@ -0,0 +1,163 @@
+# Vectorised analytics over all writers' visits at once.
+# The whole writers x months matrix is loaded in one query, every measure
+# is a NumPy expression over it, results go to `writer_analytics`.
+#
+# python analytics.py [database]
+
+import sys
+import time
+import pathlib
+
+import numpy as np
+
+from models import Dataset, month_index, month_yyyymm
+
+
+
+def visits_matrix(ds: Dataset):
+    """
+    Returns (qids, months, matrix): writer_qid array, YYYYMM array of columns
+    and int64 matrix writers x months, months without data are zeros.
+    Reads `series` when Dataset.storage is 'series', `visits` rows otherwise.
+    """
+
+    if ds.storage == 'series':
+        series = ds.load_series()
+        if not series:
+            return np.zeros(0, 'i8'), np.zeros(0, 'i8'), np.zeros((0, 0), 'i8')
+        first = min(month_index(start) for start, _ in series.values())
+        last = max(month_index(start) + len(views) - 1 for start, views in series.values())
+        qids = np.fromiter(series, 'i8', len(series))
+        matrix = np.zeros((len(qids), last - first + 1), 'i8')
+        for row, (start, views) in enumerate(series.values()):
+            offset = month_index(start) - first
+            matrix[row, offset:offset + len(views)] = views
+    else:
+        cur = ds.con.cursor()
+        cur.row_factory = None  # plain tuples, sqlite3.Row is slow to convert
+        rows = np.array(cur.execute('SELECT writer_qid, yearmonth, visits FROM visits').fetchall(),
+                        dtype='f8').reshape(-1, 3)
+        if not len(rows):
+            return np.zeros(0, 'i8'), np.zeros(0, 'i8'), np.zeros((0, 0), 'i8')
+        yyyymm = np.rint(rows[:, 1] * 100).astype('i8')
+        columns = yyyymm // 100 * 12 + yyyymm % 100 - 1
+        first = columns.min()
+        qids, writer = np.unique(rows[:, 0].astype('i8'), return_inverse=True)
+        matrix = np.zeros((len(qids), columns.max() - first + 1), 'i8')
+        matrix[writer, columns - first] = rows[:, 2].astype('i8')
+
+    months = np.array([month_yyyymm(first + n) for n in range(matrix.shape[1])], 'i8')
+    return qids, months, matrix
+
+
+
+def analyse(months: np.ndarray, matrix: np.ndarray, window: int = 12) -> dict:
+    """
+    Computes per writer measures over the matrix, every value is an array
+    in the row order of the matrix.
+
+    trend           Least squares slope of views per month over the last 2 * `window` months
+    yoy             Growth of the last `window` months over the previous ones,
+                    NaN without a base or with less than 2 * `window` months
+    peak_month      Calendar month (1-12) with the highest average views
+    seasonality     Spread of the calendar month profile: std / mean, 0 for flat series
+    rank            Place by the last `window` months views, 1 is the most visited
+    rank_change     Places gained since the previous `window` months, NaN as yoy
+    percentile      Share of writers with fewer total views, 0-100
+
+    """
+
+    writers = len(matrix)
+    views = matrix.astype('f8')
+
+    recent = views[:, -window:].sum(axis=1)
+    previous = views[:, -2 * window:-window].sum(axis=1)
+
+    tail = views[:, -2 * window:]
+    x = np.arange(tail.shape[1], dtype='f8')
+    x -= x.mean()
+    trend = tail @ x / (x @ x) if x.any() else np.zeros(writers)
+
+    # Without two full windows there is no base to compare with
+    compared = views.shape[1] >= 2 * window
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        yoy = np.where(previous > 0, recent / previous - 1, np.nan) if compared else \
+              np.full(writers, np.nan)
+
+    # Calendar profile: average views per month of the year
+    calendar = months % 100 - 1
+    profile = np.zeros((writers, 12))
+    np.add.at(profile.T, calendar, views.T)
+    profile /= np.maximum(np.bincount(calendar, minlength=12), 1)
+    mean = profile.mean(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        seasonality = np.where(mean > 0, profile.std(axis=1) / mean, 0.)
+
+    def places(values):
+        order = np.argsort(-values, kind='stable')
+        result = np.empty(writers, 'i8')
+        result[order] = np.arange(1, writers + 1)
+        return result
+
+    rank = places(recent)
+    total = views.sum(axis=1)
+    percentile = np.searchsorted(np.sort(total), total, side='left') * 100. / max(writers, 1)
+
+    return {
+        'trend': trend,
+        'yoy': yoy,
+        'peak_month': profile.argmax(axis=1) + 1,
+        'seasonality': seasonality,
+        'rank': rank,
+        'rank_change': (places(previous) - rank) if compared else np.full(writers, np.nan),
+        'percentile': percentile,
+        }
+
+
+
+def store(ds: Dataset, qids: np.ndarray, results: dict):
+    """
+    Replaces `writer_analytics` with the computed measures.
+    """
+
+    fields = ('trend', 'yoy', 'peak_month', 'seasonality', 'rank', 'rank_change', 'percentile')
+    columns = [qids.tolist()] + [
+        [None if value != value else value for value in results[name].tolist()]
+        for name in fields]
+
+    ds.cur.execute('DELETE FROM writer_analytics')
+    ds.cur.executemany('INSERT INTO writer_analytics (writer_qid, {}) VALUES ({})'.format(
+                        ', '.join(fields), ', '.join('?' * (len(fields) + 1))),
+                       zip(*columns))
+    ds.commit()
+
+
+
+def run(ds: Dataset, window: int = 12) -> int:
+    """
+    Loads, analyses and stores, prints timing of every step, returns number of writers.
+    """
+
+    start = time.time()
+    qids, months, matrix = visits_matrix(ds)
+    loaded = time.time()
+    print('Loaded {} writers x {} months in {:.3f} s'.format(*matrix.shape, loaded - start))
+
+    results = analyse(months, matrix, window)
+    analysed = time.time()
+    print('Analysed in {:.3f} s'.format(analysed - loaded))
+
+    store(ds, qids, results)
+    print('Stored in {:.3f} s'.format(time.time() - analysed))
+
+    return len(qids)
+
+
+
+if __name__ == '__main__':
+
+    ds = Dataset(sys.argv[1] if len(sys.argv) > 1 else
+                 pathlib.Path(__file__).parent / 'writers_list2.sqlite3')
+    run(ds)
+    ds.close()
@@ -1,18 +1,24 @@
-import sqlite3
 import time
 
 from datetime import datetime
 
 from openpyxl import Workbook
 
+from metrics import metrics
+from models import Dataset
 
 
+
+# Totals are kept up to date by Dataset.insert_stat() in `writer_totals`,
+# so there is no aggregation over the whole `visits` table here.
+# Dataset creates the table and fills it once for older databases.
+
 visits_query = """
-SELECT DISTINCT
+SELECT
     writers.writer,
-    visits.writer_qid,
-    sum(visits.visits),
-    avg(visits.visits),
+    writer_totals.writer_qid,
+    writer_totals.total,
+    writer_totals.average,
     writers.ethnicity,
     writers.language,
     writers.birthdate,
@@ -21,52 +27,43 @@ SELECT DISTINCT
     writers.geo_lat,
     writers.geo_lon,
     writers.article
-FROM writers, visits
-WHERE writers.writer_qid = visits.writer_qid
+FROM writers, writer_totals
+WHERE writers.writer_qid = writer_totals.writer_qid
 GROUP BY writers.writer_qid
 """
 
 def fetch_query(query):
+    """
+    Yields rows of the query one by one straight from the cursor,
+    so the result set never sits in memory as a whole.
+    """
+
     start = time.time()
     print("Starting query:\n", query)
     print('Execution is on the go...\n')
 
-    con = sqlite3.connect('writers_list2.sqlite3')
-    cur = con.cursor()
+    ds = Dataset('writers_list2.sqlite3')
+    cur = ds.con.cursor()
+    cur.row_factory = None  # plain tuples
+    cur.arraysize = 1000
 
     conntime = time.time()
     print('Connect time: ', conntime-start)
 
-    result = con.execute(query)
+    with metrics.timer('sql_seconds', statement='fetch_query'):
+        result = cur.execute(query)
     executetime = time.time()
-    print('Execute time: ', executetime-conntime)
-
-    fetched = result.fetchall()
-    fetchtime = time.time()
-
-    print('Fetch time:   ', fetchtime-executetime)
-    print('Total time:   ', fetchtime-start, '\n')
-
-    con.close()
-
-    return fetched
+    print('Execute time: ', executetime-conntime, '\n')
 
+    try:
+        while True:
+            fetched = result.fetchmany()
+            if not fetched: break
+            yield from fetched
+    finally:
+        ds.close()
 
-rows = fetch_query(visits_query)
-
-wb = Workbook()
-# wb.iso_dates = True
-
-ws = wb.active
-ws.title = "Writers info"
-
-print('Writing XLSX file...')
-
-start = time.time()
 
-ws.append(('Автор', 'Wikidata ID', 'Посещений', 'Посещений в среднем',
-            'Национальность', 'Язык', 'Дата рождения', 'Дата смерти',
-            'Место рождения', 'Широта', 'Долгота', 'Wikipedia'))
 
 def generate_date(item):
     try:
@@ -80,25 +77,58 @@ def generate_date(item):
 
     return f'{parsedate.day:02d}.{parsedate.month:02d}.{parsedate.year}'
 
-for num, row in enumerate(rows):
-    ws.append((
-        str(row[0]),
-        int(row[1]),
-        int(row[2]),
-        float(row[3]),
-        str(row[4]),
-        str(row[5]),
-        generate_date(row[6]),
-        generate_date(row[7]),
-        str(row[8]),
-        float(row[9]),
-        float(row[10]),
-        str(row[11])
-        ))
-    print('Added row {:>5d}'.format(num), sep='', end='\r')
-
-print ('\nAdded at', time.time()-start, 'seconds')
-
-wb.save(filename = 'writers_stat.xlsx')
-
-print ('File saved.')
+
+
+def export(rows, filename, every: float = .5):
+    """
+    Writes rows through a write-only (constant memory) worksheet.
+    Progress line is refreshed not more often than `every` seconds.
+    """
+
+    wb = Workbook(write_only=True)
+    # wb.iso_dates = True
+
+    ws = wb.create_sheet(title="Writers info")
+
+    print('Writing XLSX file...')
+
+    start = shown = time.time()
+
+    ws.append(('Автор', 'Wikidata ID', 'Посещений', 'Посещений в среднем',
+                'Национальность', 'Язык', 'Дата рождения', 'Дата смерти',
+                'Место рождения', 'Широта', 'Долгота', 'Wikipedia'))
+
+    num = 0
+    for num, row in enumerate(rows, 1):
+        ws.append((
+            str(row[0]),
+            int(row[1]),
+            int(row[2]),
+            float(row[3]),
+            str(row[4]),
+            str(row[5]),
+            generate_date(row[6]),
+            generate_date(row[7]),
+            str(row[8]),
+            float(row[9]),
+            float(row[10]),
+            str(row[11])
+            ))
+        if time.time() - shown >= every:
+            shown = time.time()
+            print('Added row {:>7d}'.format(num), sep='', end='\r')
+
+    print('Added row {:>7d}'.format(num))
+    metrics.inc('rows_total', num, table='xlsx')
+    print ('Added at', time.time()-start, 'seconds')
+
+    with metrics.timer('export_save_seconds'):
+        wb.save(filename = filename)
+
+    print ('File saved.')
+
+
+
+if __name__ == '__main__':
+    metrics.install('writers_stat.metrics.json')
+    export(fetch_query(visits_query), 'writers_stat.xlsx')
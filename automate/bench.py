@@ -0,0 +1,262 @@
+# Benchmarks for the pipeline stages: python bench.py <name> [args]
+#
+#   python bench.py import writers.csv   serial collector path vs parallel importer
+#   python bench.py qindex [rows]        OFFSET vs keyset paging latency over a qindex stand-in
+#   python bench.py decode [dir]         text + full JSON vs bytes projection of pageviews responses
+#   python bench.py harvest [writers] [latency] [errors] [throttle] [concurrency] [adaptive]
+#                                        both harvesters end to end against fakeapi.py
+
+import csv
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from models import Person, Database, parse_pageviews
+
+
+
+def _timed(title: str, func, *args):
+    start = time.perf_counter()
+    rows = func(*args)
+    elapsed = time.perf_counter() - start
+    print(f'{title:<12} {rows:>10} rows {elapsed:>8.2f} s {rows / (elapsed or 1):>10.0f} rows/s')
+    return elapsed
+
+
+
+def bench_import(path: str):
+    """
+    Loads the same CSV into two fresh databases, the way collector.py does
+    and through the process pool of importer.py, and prints both rates.
+    """
+
+    import importer
+
+    def serial(db):
+        with open(path, newline='', encoding='utf-8') as f:
+            return db.bulk_insert((Person(row).astuple() for row in csv.DictReader(f)),
+                                  Person.fields)
+
+    def parallel(db):
+        return importer.load(path, db)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for title, func in (('serial', serial), ('parallel', parallel)):
+            db = Database(os.path.join(tmp, f'{title}.sqlite3'))
+            db.tune()
+            results[title] = _timed(title, func, db)
+            db.close()
+
+    print(f'speedup      {results["serial"] / results["parallel"]:.2f}x')
+
+
+
+def bench_qindex(rows: str = '1000000', limit: str = '190'):
+    """
+    Builds a qindex-shaped SQLite table as a local stand-in for PostgreSQL
+    and pages through it with LIMIT/OFFSET and with statistics.read_qindex().
+    Prints the latency of the first, middle and last batches of both.
+    """
+
+    import sqlite3
+    from statistics import read_qindex
+
+    rows, limit = int(rows), int(limit)
+
+    con = sqlite3.connect(':memory:')
+    con.execute('CREATE TABLE qindex (qid INTEGER PRIMARY KEY, label TEXT NOT NULL)')
+    con.executemany('INSERT INTO qindex VALUES (?, ?)',
+                    ((qid, f'Article_{qid}') for qid in range(1, rows * 2, 2)))
+    cur = con.cursor()
+
+    def offset_pages():
+        for offset in range(0, rows, limit):
+            yield cur.execute('SELECT qid, label FROM qindex LIMIT ? OFFSET ?',
+                              (limit, offset)).fetchall()
+
+    for title, pages in (('offset', offset_pages()),
+                         ('keyset', read_qindex(cur, limit, mark='?'))):
+        latency = []
+        while True:
+            start = time.perf_counter()
+            batch = next(pages, None)
+            if batch is None: break
+            latency.append(time.perf_counter() - start)
+
+        first, middle, last = (latency[i] * 1000 for i in (0, len(latency) // 2, -1))
+        print(f'{title:<8} {len(latency):>6} batches  first {first:7.3f} ms  '
+              f'middle {middle:7.3f} ms  last {last:7.3f} ms  total {sum(latency):6.2f} s')
+
+
+
+def sample_response(article: str = 'Leo_Tolstoy', months: int = 73) -> bytes:
+    """
+    Pageviews API response body in the same layout as wikimedia.org returns.
+    """
+
+    items = []
+    for n in range(months):
+        year, month = 2015 + (n + 6) // 12, (n + 6) % 12 + 1
+        items.append({'project': 'en.wikipedia', 'article': article, 'granularity': 'monthly',
+                      'timestamp': f'{year}{month:02d}0100', 'access': 'all-access',
+                      'agent': 'user', 'views': 1000 + n * 37})
+    return json.dumps({'items': items}, separators=(',', ':')).encode('utf-8')
+
+
+
+def bench_decode(path: str = None, repeat: str = '20'):
+    """
+    Decodes recorded response bodies (files in `path`, or generated samples)
+    the old way - text, full JSON, dict per item - and with parse_pageviews().
+    Prints CPU time and allocated memory per article for both.
+    """
+
+    if path:
+        bodies = [p.read_bytes() for p in sorted(pathlib.Path(path).iterdir()) if p.is_file()]
+    else:
+        bodies = [sample_response(f'Article_{n}') for n in range(1000)]
+
+    def text_json(body):
+        items = json.loads(body.decode('utf-8'))['items']
+        return [(int(item['timestamp'][:6]), item['views']) for item in items]
+
+    for title, decode in (('text+json', text_json), ('projection', parse_pageviews)):
+        start = time.process_time()
+        for _ in range(int(repeat)):
+            for body in bodies:
+                decode(body)
+        cpu = (time.process_time() - start) / int(repeat) / len(bodies)
+
+        tracemalloc.start()
+        kept = [decode(body) for body in bodies]
+        allocated = tracemalloc.get_traced_memory()[0] / len(bodies)
+        tracemalloc.stop()
+        del kept
+
+        print(f'{title:<12} {cpu * 1e6:8.1f} us/article  {allocated:8.0f} bytes/article kept')
+
+
+
+def bench_harvest(writers: str = '2000', latency: str = '.05', errors: str = '.01',
+                  throttle: str = '0', concurrency: str = '90', adaptive: str = '1'):
+    """
+    Starts fakeapi.py in a separate process and drives both harvesters against it:
+    getstats.iter_writers() into a fresh SQLite database and statistics.run()
+    into a CSV file (with a SQLite qindex stand-in for PostgreSQL).
+    Prints requests/second, p50/p99 request latency (with retries) and rows/second.
+    `adaptive` 1 or 0 turns AdaptiveLimit on or off in both.
+    """
+
+    import asyncio
+    import socket
+    import sqlite3
+    from multiprocessing import Process
+
+    import fakeapi
+    import getstats
+    import statistics
+    from models import Client, Dataset, Statistics, apply_scheme
+
+    writers, concurrency, adaptive = int(writers), int(concurrency), adaptive == '1'
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = Process(target=fakeapi.serve, daemon=True,
+                     args=(port, float(latency), float(errors), .05, float(throttle)))
+    server.start()
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(.1)
+
+    api = f'http://127.0.0.1:{port}/api/rest_v1/metrics'
+    latencies = []
+
+    class TimedClient(Client):
+        async def get(self, url, decode):
+            start = time.perf_counter()
+            try:
+                return await super().get(url, decode)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+    def report(title, elapsed, rows):
+        latencies.sort()
+        p50, p99 = (latencies[int(len(latencies) * q)] * 1000 for q in (.5, .99))
+        print(f'{title:<12} {len(latencies) / elapsed:8.1f} req/s  p50 {p50:7.1f} ms  '
+              f'p99 {p99:7.1f} ms  {rows / elapsed:9.0f} rows/s')
+        latencies.clear()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        con = sqlite3.connect(os.path.join(tmp, 'writers.sqlite3'))
+        apply_scheme(con.cursor())
+        con.executemany('INSERT INTO writers (writer_qid, writer, birthplace_qid, birthplace, '
+                        'geo_lat, geo_lon, ethnicity_qid, ethnicity, language_qid, language, article) '
+                        "VALUES (?, '', 0, '', 0, 0, 0, '', 0, '', ?)",
+                        ((qid, f'https://ru.wikipedia.org/wiki/Article_{qid}')
+                         for qid in range(1, writers + 1)))
+        con.commit()
+
+        ds = Dataset(os.path.join(tmp, 'writers.sqlite3'))
+        ds.fields = 'writer_qid, article'
+        ds.limit = 90
+        ds.keyset = True
+        Statistics.api = api
+        getstats.Client = TimedClient
+
+        start = time.perf_counter()
+        asyncio.run(getstats.iter_writers(ds, concurrency, adaptive=adaptive))
+        elapsed = time.perf_counter() - start
+        report('getstats', elapsed, ds.con.execute('SELECT count(*) FROM visits').fetchone()[0])
+        ds.close()
+
+        con.execute('CREATE TABLE qindex (qid INTEGER PRIMARY KEY, label TEXT NOT NULL)')
+        con.execute('CREATE TABLE qindex_failed (qid TEXT PRIMARY KEY, label TEXT NOT NULL, '
+                    'error TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 1)')
+        con.executemany('INSERT INTO qindex VALUES (?, ?)',
+                        ((qid, f'Article_{qid}') for qid in range(1, writers + 1)))
+        con.commit()
+
+        statistics.URL = api + '/pageviews/per-article/{project}/all-access/user' + \
+                         '/{article}/{granularity}/{start}/{end}'
+        statistics.Client = TimedClient
+        statistics.conn, statistics.cur, statistics.mark = con, con.cursor(), '?'
+        statistics.replay, statistics.after, statistics.limit, statistics.rate = False, None, 190, None
+        statistics.adaptive = adaptive
+        statistics.global_counter, statistics.global_time = 0, time.time()
+        statistics.output = os.path.join(tmp, 'visits.csv')
+        statistics.prepare_output(statistics.output)
+
+        start = time.perf_counter()
+        statistics.harvest(None, None)
+        elapsed = time.perf_counter() - start
+        print()
+        report('statistics', elapsed, statistics.global_counter)
+        con.close()
+
+    server.terminate()
+
+
+
+benchmarks = {
+    'import': bench_import,
+    'qindex': bench_qindex,
+    'decode': bench_decode,
+    'harvest': bench_harvest,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print('Usage: python bench.py {} [args]'.format('|'.join(benchmarks)))
+        sys.exit(1)
+
+    benchmarks[sys.argv[1]](*sys.argv[2:])
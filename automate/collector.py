@@ -1,26 +1,58 @@
 # Export CSV wikidata to SQLite3 database after formatting
 
 import csv
+import sys
+import time
 
 from models import Person, Database
 
-db: object = Database('writers_list2.sqlite3')
+table_fields = Person.fields
 
-table_fields = [n for n in dir(Person) if not n.startswith('_')]
 
-with open ('writers.csv', newline='') as csvfile:
-    writers = csv.DictReader(csvfile)
+def glittered(writers):
+    """
+    Yields table rows from CSV rows one by one, so the whole file never sits in memory.
+    """
 
     for writer in writers:
-        writer_glittered = Person(writer)
-        table_row = {field : getattr(writer_glittered, field) for field in table_fields}
+        yield Person(writer).astuple()
+
+
+if __name__ == '__main__':
+
+    # Pool children under spawn (macOS, Windows) import this file again,
+    # so everything that runs lives under the guard
+
+    db: object = Database('writers_list2.sqlite3')
+    db.tune()
+
+    start = time.time()
+
+    # python collector.py parallel - parse CSV in a process pool (see importer.py),
+    # worth it for big dumps, for a few thousand rows the serial path is as fast.
+
+    if sys.argv[1:2] == ['parallel']:
+        import importer
+
         try:
-            db.insert_writer(table_row)
+            total = importer.load('writers.csv', db, table_fields, batch=10000)
         except Exception as e:
-            print('\n', e, '\n', table_row, sep='')
-            break
+            print('\n', e, sep='')
+            total = 0
+
+    else:
+        with open ('writers.csv', newline='') as csvfile:
+            writers = csv.DictReader(csvfile)
+
+            try:
+                total = db.bulk_insert(glittered(writers), table_fields, batch=10000)
+            except Exception as e:
+                print('\n', e, sep='')
+                total = 0
+
+    elapsed = time.time() - start
 
-db.commit()
-db.close()
+    db.close()
 
-print('\nAll done')
+    print(f'\n{total} rows in {elapsed:.2f} seconds, {total / (elapsed or 1):.0f} rows/second')
+    print('All done')
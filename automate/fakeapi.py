@@ -0,0 +1,107 @@
+# Local stand-in for the Wikimedia pageviews API, to load-test the harvesters
+# without wikimedia.org. Answers /metrics/pageviews/per-article/... in the same
+# layout as the real API with made-up, but stable for an article, views.
+#
+# python fakeapi.py [--port 8765] [--latency .05] [--errors .01] [--missing .05] [--throttle 100]
+#
+# Point the harvesters to it with
+#   models.Statistics.api = 'http://127.0.0.1:8765/api/rest_v1/metrics'
+#   statistics.URL = 'http://127.0.0.1:8765/api/rest_v1/metrics/pageviews/per-article/...'
+
+import time
+import random
+import asyncio
+import argparse
+
+from zlib import crc32
+
+from aiohttp import web
+
+from models import plan_periods
+
+
+ROUTE = '/api/rest_v1/metrics/pageviews/per-article/{project}/{access}/{agent}' + \
+        '/{article}/{granularity}/{start}/{end}'
+
+
+
+def make_app(latency: float = .05, errors: float = .01, missing: float = .05,
+             throttle: float = 0) -> web.Application:
+    """
+    Returns the fake API application.
+
+    Parameters:
+    latency: float   Mean answer delay in seconds, uniformly spread by +-50%
+    errors: float    Share of answers with HTTP 503
+    missing: float   Share of articles answered with HTTP 404, the same articles every time
+    throttle: float  Max requests per second, the rest get HTTP 429 with Retry-After, 0 - no limit
+
+    """
+
+    window = {'second': 0, 'requests': 0}
+    stats = {'requests': 0, 'throttled': 0, 'errors': 0}
+
+    async def pageviews(request):
+        stats['requests'] += 1
+        info = request.match_info
+
+        now = int(time.monotonic())
+        if window['second'] != now:
+            window['second'], window['requests'] = now, 0
+        window['requests'] += 1
+        if throttle and window['requests'] > throttle:
+            stats['throttled'] += 1
+            return web.Response(status=429, headers={'Retry-After': '1'})
+
+        await asyncio.sleep(latency * random.uniform(.5, 1.5))
+
+        if random.random() < errors:
+            stats['errors'] += 1
+            return web.Response(status=503)
+
+        seed = crc32(info['article'].encode('utf-8'))
+        if seed % 10000 < missing * 10000:
+            return web.json_response({'type': 'https://mediawiki.org/wiki/HyperSwitch/errors/not_found',
+                                      'title': 'Not found.'}, status=404)
+
+        items = ','.join(
+            '{{"project":"{}","article":"{}","granularity":"{}","timestamp":"{}00",'
+            '"access":"{}","agent":"{}","views":{}}}'.format(
+                info['project'], info['article'], info['granularity'], period,
+                info['access'], info['agent'], (seed + period) % (seed % 5000 + 1))
+            for period in plan_periods(info['start'][:8], info['end'][:8], info['granularity']))
+        return web.Response(body=f'{{"items":[{items}]}}'.encode('utf-8'),
+                            content_type='application/json')
+
+    async def show_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_get(ROUTE, pageviews)
+    app.router.add_get('/stats', show_stats)
+    return app
+
+
+
+def serve(port: int = 8765, latency: float = .05, errors: float = .01,
+          missing: float = .05, throttle: float = 0):
+    """
+    Runs the fake API on 127.0.0.1:port until interrupted.
+    """
+
+    web.run_app(make_app(latency, errors, missing, throttle),
+                host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Fake Wikimedia pageviews API')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=.05, help='mean delay, seconds')
+    parser.add_argument('--errors', type=float, default=.01, help='share of HTTP 503')
+    parser.add_argument('--missing', type=float, default=.05, help='share of HTTP 404')
+    parser.add_argument('--throttle', type=float, default=0, help='requests per second before HTTP 429')
+    args = parser.parse_args()
+
+    serve(args.port, args.latency, args.errors, args.missing, args.throttle)
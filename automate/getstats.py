@@ -1,64 +1,272 @@
 # Check visits statistics for wikipedia articles
 
+import sys
 import sqlite3
 import pathlib
 import asyncio
 
+from collections import deque
 from datetime import datetime, timedelta
 
-from models import Dataset, Statistics
+from metrics import metrics
+from models import Dataset, Statistics, Client, Checkpoint, ResponseCache, next_month, sitelink_counts
 
 
+# The first month of the pageviews history we keep
+STARTDATE = '20150101'
 
-async def getstat(chunk):
+# Articles of the `writers` table, other projects are harvested by projects.py
+PROJECT = 'ru.wikipedia.org'
+
+
+
+class Watermark(object):
+    """
+    Tracks rows which are still in flight and gives the highest key
+    whose rows (and all rows before it) are already stored in the database.
+    Rows are finished in any order, so Dataset.after can't be used for resume.
+
+    """
+
+    def __init__(self, after=None):
+        self.key = after
+        self._pending = {}   # key -> rows not yet stored
+        self._order = deque() # keys in the order of Dataset
+
+
+    def push(self, key):
+        if key not in self._pending:
+            self._pending[key] = 0
+            self._order.append(key)
+        self._pending[key] += 1
+
+
+    def done(self, key):
+        self._pending[key] -= 1
+        while self._order and not self._pending[self._order[0]]:
+            self.key = self._order.popleft()
+            del self._pending[self.key]
+
+
+
+def order_key(ds, item):
+    """
+    Resume key of the row: its Dataset.order_by value (writer_qid or priority rank),
+    failures replayed from the dead-letter table have writer_qid only.
+    """
+
+    return item.get(ds.order_by, item['writer_qid'])
+
+
+
+async def produce(ds, rows: asyncio.Queue, watermark: Watermark, workers: int,
+                  replay: bool, incremental: bool, project: str = PROJECT, target: str = 'visits'):
+    """
+    Streams writer rows from the Dataset (or from its dead-letter table
+    in replay mode) into the bounded queue, then sends a stop marker to every worker.
+
+    In incremental mode every row gets `startdate` right after its latest
+    stored month, and writers which are already up to date are skipped.
+    Replay takes failed articles of the `project` only, all of them if None,
+    kept for the `target` table.
+
+    """
+
+    chunks = iter([ds.failures(project, target)]) if replay else iter(ds.iter_chunk, None)
+    thismonth = datetime.now().strftime('%Y%m01')
+
+    for chunk in chunks:
+        last = ds.last_months(item['writer_qid'] for item in chunk) if incremental else {}
+        for item in chunk:
+            if item['writer_qid'] in last:
+                item['startdate'] = next_month(last[item['writer_qid']])
+                if item['startdate'] >= thismonth: continue
+            watermark.push(order_key(ds, item))
+            await rows.put(item)
+
+    for _ in range(workers):
+        await rows.put(None)
+
+
+
+async def fetch(client, rows: asyncio.Queue, results: asyncio.Queue):
     """
-    Getting Wikipedia statistics in async mode via Statistics().async_wikistat()
+    Worker: takes rows one by one, so a slow article holds only its own slot.
     """
 
-    tasks = [asyncio.create_task(Statistics(item, startdate='20150101').async_wikistat())
-                for item in chunk]
+    while True:
+        item = await rows.get()
+        if item is None: break
+        request = Statistics(item, startdate=item.get('startdate', STARTDATE), client=client)
+        stat = await request.async_wikistat()
+        await results.put((item, stat, request.error, request.missed))
+
+    await results.put(None)
+
+
+
+async def consume(ds, results: asyncio.Queue, watermark: Watermark, workers: int,
+                  batch: int, replay: bool, checkpoint: Checkpoint = None, store=None,
+                  client: Client = None, target: str = 'visits'):
+    """
+    Collects fetched statistics and writes them with one insert_stat() call per batch,
+    or with `store` (see projects.py).
+    Failed requests go to the dead-letter table marked with the `target` table,
+    replayed successes leave it, offline cache misses stay where they are.
+    The checkpoint gets the resume key after every committed batch.
+    Progress shows the requests window of an adaptive `client`.
+    """
+
+    stored, items, failed, missed, stopped = [], [], [], [], 0
+    done = checkpoint.load().get('done', 0) if checkpoint else 0
+    store = store or ds.insert_stat
+
+    def flush():
+        nonlocal done
+        store(stored)
+        ds.insert_failures(failed, target)
+        if replay:
+            kept = {id(item) for item, _ in failed} | {id(item) for item in missed}
+            ds.delete_failures([item for item in items if id(item) not in kept], target)
+        for item in items:
+            watermark.done(order_key(ds, item))
+        done += len(items)
+        stored.clear()
+        items.clear()
+        failed.clear()
+        missed.clear()
+        if checkpoint is not None:
+            checkpoint.save(after=watermark.key, done=done)
+        window = ', window: {:.0f}'.format(client.window) if client is not None and client.adaptive else ''
+        print ('\rRows done: {}, resume key: {}{}        '.format(done, watermark.key, window), end='')
+
+    while stopped < workers:
+        result = await results.get()
+        if result is None:
+            stopped += 1
+            continue
+        item, stat, error, miss = result
+        items.append(item)
+        if stat:
+            stored.append(stat)
+        if error:
+            failed.append((item, error))
+        if miss:
+            missed.append(item)
+        if len(items) >= batch:
+            flush()
 
-    st = await asyncio.gather(*tasks)
-    return st
+    flush()
 
 
 
-def iter_writers():
+async def iter_writers(ds, concurrency: int = 90, batch: int = 500,
+                       rate: float = None, replay: bool = False, incremental: bool = False,
+                       checkpoint: Checkpoint = None, cache: ResponseCache = None,
+                       adaptive: bool = False):
     """
     Plucking writers step by step getting statistics then keeping it.
-    Step width defined in Dataset.limit.
-    Every call of iter_chunk() increase offset according to limit value.
+
+    Producer, `concurrency` workers and a consumer are linked by bounded queues,
+    so there are always requests in flight while SQLite is read or written.
+    All requests of the run share the same Client and its connection pool,
+    writers with the same article share one download.
+    The printed resume key is safe to restart the script after a crash.
+
+    `rate` caps requests per second, `replay` refetches the dead-letter table
+    instead of walking writers, `incremental` requests only months
+    which are not in the database yet. `checkpoint` journals the resume key
+    after every batch and is cleared when the whole pass is done.
+    `cache` keeps answers on disk, see ResponseCache. `adaptive` lets the Client
+    find the number of requests in flight up to `concurrency` by itself.
 
     """
 
-    global ds
-    chunk = True
+    rows = asyncio.Queue(maxsize=concurrency * 2)
+    results = asyncio.Queue(maxsize=batch * 2)
+    watermark = Watermark(ds.after)
 
-    while chunk:
-        chunk = ds.iter_chunk()
-        next_set = asyncio.run(getstat(chunk))
-        ds.insert_stat(next_set)
+    async with Client(limit=concurrency, rate=rate, cache=cache, adaptive=adaptive) as client:
+        await asyncio.gather(
+            produce(ds, rows, watermark, concurrency, replay, incremental),
+            consume(ds, results, watermark, concurrency, batch, replay, checkpoint, client=client),
+            *(fetch(client, rows, results) for _ in range(concurrency))
+        )
 
-        print ('\rCurrent offset: {}        '.format(ds.offset), end='')
+    if checkpoint is not None:
+        checkpoint.clear()
 
     print()
+    print('Requests shared by writers with the same article: {}'.format(client.coalesced))
+    return watermark.key
+
+
+
+if __name__ == '__main__':
+
+    # Counters and timings go to the file at exit and on SIGUSR1,
+    # name it *.prom for Prometheus text format
+    metrics.install(pathlib.Path(__file__).parent / 'getstats.metrics.json')
+
+    # Dataset initial setup
+
+    ds = Dataset(pathlib.Path(__file__).parent / 'writers_list2.sqlite3')
+    ds.fields = 'writer_qid, article'
+    ds.limit = 90
+    ds.keyset = True
+
+    # 'series' keeps a packed array per writer instead of a row per month,
+    # the existing rows are converted once with ds.pack_series()
+    ds.storage = 'rows'
+
+    # Most popular writers first (sitelinks count and visits we already have),
+    # so an interrupted run has the most valuable articles. False - by writer_qid.
+    priority = True
+    if priority:
+        ds.table = 'writers_by_priority'
+        ds.order_by = 'priority'
+        ds.fields = 'writer_qid, article, priority'
+
+    # Max number of simultaneous requests to the pageviews API
+    concurrency = 90
+
+    # Find the real number of requests in flight (up to `concurrency`) at runtime:
+    # grow while answers are fast, halve on 429, 5xx and timeouts
+    adaptive = True
+
+    # Max requests per second, the pageviews API allows about 100
+    rate = 90
 
+    # Request only months after the latest stored one for every writer
+    incremental = True
 
+    # Answers are kept on disk, closed months are never asked again.
+    # offline=True replays recorded answers only, without the network.
+    cache = ResponseCache(pathlib.Path(__file__).parent / 'cache', offline=False)
 
-# Dataset initial setup
+    # After a crash the run resumes from the checkpoint by itself,
+    # or from a given key: python getstats.py <resume key>
+    # Refetch failed requests only: python getstats.py replay
+    replay = sys.argv[1:2] == ['replay']
+    checkpoint = None if replay else Checkpoint(pathlib.Path(__file__).parent / 'getstats.checkpoint.json')
+    if len(sys.argv) > 1 and not replay:
+        ds.after = int(sys.argv[1])
+    elif checkpoint is not None:
+        ds.after = checkpoint.load().get('after')
 
-ds = Dataset(pathlib.Path(__file__).parent / 'writers_list2.sqlite3')
-ds.fields = 'writer_qid, article'
-ds.limit = 90
-# ds.offset = 10700
+    # Ranks are recounted for a new pass only, resume keys point into them
+    if priority and ds.after is None and not replay:
+        ds.update_priority(sitelink_counts(pathlib.Path(__file__).parent.parent / 'rawsrc' / 'wikipedia.csv'))
 
 
-# Main cycle run
+    # Main cycle run
 
-iter_writers()
+    asyncio.run(iter_writers(ds, concurrency, rate=rate, replay=replay, incremental=incremental,
+                             checkpoint=checkpoint, cache=cache, adaptive=adaptive))
+    print('Cache hits: {}, misses: {}'.format(cache.hits, cache.misses))
 
 
-# Close the database
+    # Close the database
 
-ds.commit()
-ds.close()
+    ds.commit()
+    ds.close()
@@ -0,0 +1,92 @@
+# Parallel CSV to SQLite3 import for big Wikidata dumps.
+# The file is cut into byte ranges on line boundaries, shards are parsed
+# and converted in a process pool, the only writer is the main process.
+#
+# Rows must not contain line breaks inside quoted values, which holds
+# for Wikidata query service CSV exports (labels have no newlines).
+
+import csv
+import io
+import os
+
+from multiprocessing import Pool
+
+from models import Person, Database
+
+
+
+def person_row(fieldnames: list, values: list) -> tuple:
+    """
+    Default converter: CSV values to the `writers` row in Person.fields order.
+    """
+
+    return Person(dict(zip(fieldnames, values))).astuple()
+
+
+
+def shards(path, size: int = 8 * 1024 * 1024):
+    """
+    Yields (start, end) byte ranges of about `size` bytes after the header line,
+    every range starts at the beginning of a line and ends right after a newline.
+    """
+
+    total = os.path.getsize(path)
+
+    with open(path, 'rb') as f:
+        f.readline()  # header
+        start = f.tell()
+        while start < total:
+            f.seek(min(start + size, total))
+            f.readline()  # move to the next line start
+            end = min(f.tell(), total)
+            yield start, end
+            start = end
+
+
+
+def parse_shard(task) -> list:
+    """
+    Worker: reads one byte range and returns converted rows.
+    """
+
+    path, start, end, fieldnames, converter = task
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+
+    reader = csv.reader(io.StringIO(chunk.decode('utf-8'), newline=''))
+    return [converter(fieldnames, values) for values in reader if values]
+
+
+
+def load(path, db: Database, fields: tuple = Person.fields, table: str = 'writers',
+         converter=person_row, processes: int = None, shard_size: int = 8 * 1024 * 1024,
+         batch: int = 10000) -> int:
+    """
+    Imports CSV file into the table with a process pool, returns number of rows.
+
+    Parameters:
+    path            CSV file with a header line
+    db: Database    Destination, the only writer
+    fields: tuple   Table columns in the order of converter output
+    table: str      Table name
+    converter       Picklable function (fieldnames, values) -> tuple
+    processes: int  Pool size, all cores by default
+    shard_size: int Bytes per shard
+    batch: int      Rows per transaction
+
+    """
+
+    with open(path, newline='', encoding='utf-8') as f:
+        fieldnames = next(csv.reader(f))
+
+    tasks = ((path, start, end, fieldnames, converter) for start, end in shards(path, shard_size))
+
+    def rows(results):
+        for shard in results:
+            yield from shard
+
+    with Pool(processes) as pool:
+        return db.bulk_insert(rows(pool.imap_unordered(parse_shard, tasks)),
+                              fields, table=table, batch=batch)
@@ -0,0 +1,175 @@
+# Counters and latency histograms for the whole pipeline.
+# Modules record into the shared `metrics` registry, a script decides where
+# it goes: metrics.install('run.metrics.json') dumps it at exit and on SIGUSR1
+# (kill -USR1 <pid>), a .prom file gets Prometheus text format instead of JSON.
+#
+#   metrics.inc('rows_total', 500, table='visits')
+#   with metrics.timer('sql_seconds', statement='insert_stat'):
+#       ...
+
+import atexit
+import json
+import os
+import signal
+import time
+
+from contextlib import contextmanager
+
+
+# Upper bounds of histogram buckets in seconds
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+
+class Metrics(object):
+    """
+    Registry of counters and histograms, every series is a name plus labels.
+    """
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self._counters = {}     # (name, labels) -> value
+        self._histograms = {}   # (name, labels) -> [bucket counts..., +Inf count, sum]
+
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+        for n, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram[n] += 1
+                break
+        else:
+            histogram[-2] += 1
+        histogram[-1] += seconds
+
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Observes the time of the `with` block, failed blocks too.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+
+    def snapshot(self) -> dict:
+        """
+        Returns everything as plain data: counters with per second rates,
+        histograms with count, sum, mean and approximate p50/p99.
+        """
+
+        uptime = time.time() - self.started
+        result = {'uptime_seconds': uptime, 'counters': [], 'histograms': []}
+
+        for (name, labels), value in sorted(self._counters.items()):
+            result['counters'].append({'name': name, 'labels': dict(labels), 'value': value,
+                                       'per_second': value / uptime if uptime else 0})
+
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            count = sum(histogram[:-1])
+            result['histograms'].append({
+                'name': name, 'labels': dict(labels), 'count': count, 'sum': histogram[-1],
+                'mean': histogram[-1] / count if count else 0,
+                'p50': self._quantile(histogram, .5), 'p99': self._quantile(histogram, .99),
+                'buckets': dict(zip(list(map(str, self.buckets)) + ['+Inf'], histogram[:-1]))})
+
+        return result
+
+
+    def _quantile(self, histogram: list, q: float):
+        """
+        Upper bound of the bucket holding the quantile, None for the +Inf bucket.
+        """
+
+        count = sum(histogram[:-1])
+        if not count: return 0
+
+        seen = 0
+        for bound, n in zip(self.buckets, histogram):
+            seen += n
+            if seen >= q * count:
+                return bound
+        return None
+
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+
+    def to_prometheus(self) -> str:
+        """
+        Prometheus text exposition format.
+        """
+
+        def labels(pairs, **extra):
+            pairs = list(pairs) + list(extra.items())
+            return '{' + ','.join('{}="{}"'.format(k, v.replace('"', '\\"')) for k, v in pairs) + '}' \
+                   if pairs else ''
+
+        lines = ['# TYPE process_uptime_seconds gauge',
+                 f'process_uptime_seconds {time.time() - self.started}']
+
+        typed = set()
+        for (name, pairs), value in sorted(self._counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{labels(pairs)} {value}')
+
+        for (name, pairs), histogram in sorted(self._histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, n in zip(list(map(str, self.buckets)) + ['+Inf'], histogram[:-1]):
+                cumulative += n
+                lines.append(f'{name}_bucket{labels(pairs, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{labels(pairs)} {histogram[-1]}')
+            lines.append(f'{name}_count{labels(pairs)} {cumulative}')
+
+        return '\n'.join(lines) + '\n'
+
+
+    def dump(self, path):
+        """
+        Writes the registry to `path`: Prometheus text for *.prom, JSON otherwise.
+        The file is replaced at once, a reader never sees half of it.
+        """
+
+        path = str(path)
+        text = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+
+
+    def install(self, path, signum: int = getattr(signal, 'SIGUSR1', None)):
+        """
+        Dumps to `path` at exit and every time the process gets `signum`.
+        """
+
+        atexit.register(self.dump, path)
+        if signum is not None:
+            signal.signal(signum, lambda *_: self.dump(path))
+
+
+
+metrics = Metrics()
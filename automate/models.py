@@ -1,13 +1,32 @@
+import csv
 import sqlite3
 import pathlib
 import re
 import asyncio
+import hashlib
 import json
-
+import os
+import random
+import sys
+import time
+
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import islice
+from operator import attrgetter
 from datetime import datetime, timedelta
+from urllib.parse import quote, unquote
 
 import aiohttp
 
+from metrics import metrics
+
+try:
+    from orjson import loads as json_loads  # decodes bytes a few times faster
+except ImportError:
+    json_loads = json.loads
+
 
 # SELECT DISTINCT
 # 	writers.writer,
@@ -20,6 +39,252 @@ import aiohttp
 
 
 
+def apply_scheme(cur: sqlite3.Cursor):
+    """
+    Creates tables and indexes from `scheme.sql` if they don't exist yet.
+    """
+
+    with open(pathlib.Path(__file__).parent / 'scheme.sql', 'r') as scheme:
+        sql_query = scheme.read()
+
+    # Databases filled before the unique (writer_qid, yearmonth) index
+    # may hold duplicated months, keep the latest inserted row of each.
+    _unindexed = cur.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'visits' AND NOT EXISTS "
+            "(SELECT 1 FROM sqlite_master WHERE name = 'visits_writer_month')").fetchone()
+    if _unindexed:
+        cur.execute('DELETE FROM visits WHERE id NOT IN '
+                    '(SELECT max(id) FROM visits GROUP BY writer_qid, yearmonth)')
+
+    # Failures kept before the `target` column belong to getstats (visits)
+    # when they are ru.wikipedia articles, to projects.py otherwise.
+    _untargeted = cur.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'failures' AND NOT EXISTS "
+            "(SELECT 1 FROM pragma_table_info('failures') WHERE name = 'target')").fetchone()
+    if _untargeted:
+        cur.execute('ALTER TABLE failures RENAME TO failures_untargeted')
+
+    [cur.execute(query) for query in sql_query.split('\n;\n')]
+
+    # Series packed before the presence mask keep NULL there, see _insert_series()
+    if not cur.execute("SELECT 1 FROM pragma_table_info('series') WHERE name = 'present'").fetchone():
+        cur.execute('ALTER TABLE series ADD COLUMN present BLOB')
+
+    if _untargeted:
+        cur.execute("INSERT INTO failures (target, writer_qid, article, error, attempts, failed_at) "
+                    "SELECT CASE WHEN article LIKE 'https://ru.wikipedia.org/%' "
+                    "THEN 'visits' ELSE 'project_visits' END, "
+                    "writer_qid, article, error, attempts, failed_at FROM failures_untargeted")
+        cur.execute('DROP TABLE failures_untargeted')
+
+
+
+def month_index(yyyymm: int) -> int:
+    """
+    202108 -> months since year 0, to count months with plain arithmetic
+    """
+
+    return yyyymm // 100 * 12 + yyyymm % 100 - 1
+
+
+
+def month_yyyymm(index: int) -> int:
+    """
+    Reverse of month_index()
+    """
+
+    return index // 12 * 100 + index % 12 + 1
+
+
+
+def sitelink_counts(path) -> dict:
+    """
+    Reads a Wikidata query export like rawsrc/wikipedia.csv
+    (item,itemLabel,count) into {writer_qid: count}.
+    """
+
+    with open(path, newline='', encoding='utf-8') as f:
+        return {int(row['item'].rpartition('/Q')[2]): int(row['count'])
+                for row in csv.DictReader(f)}
+
+
+
+def next_month(yearmonth: float) -> str:
+    """
+    Returns the first day of the month after `yearmonth`, 2021.08 -> '20210901'
+    """
+
+    year, month = int(yearmonth), round(yearmonth % 1 * 100)
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return f'{year:04d}{month:02d}01'
+
+
+
+
+
+def plan_periods(start: str, end: str, granularity: str = 'monthly') -> list:
+    """
+    Returns all periods from `start` to `end` (both YYYYMMDD, both included)
+    as YYYYMMDD integers: first days of months for 'monthly', every day for 'daily'.
+    These are the columns a pageviews response is aligned to.
+
+    """
+
+    day = datetime.strptime(start, '%Y%m%d')
+    last = datetime.strptime(end, '%Y%m%d')
+    periods = []
+
+    if granularity == 'monthly':
+        day = day.replace(day=1)
+        while day <= last:
+            periods.append(day.year * 10000 + day.month * 100 + 1)
+            day = (day + timedelta(days=32)).replace(day=1)
+    elif granularity == 'daily':
+        while day <= last:
+            periods.append(day.year * 10000 + day.month * 100 + day.day)
+            day += timedelta(days=1)
+    else:
+        raise ValueError(f'Unknown granularity: {granularity}')
+
+    return periods
+
+
+
+def period_label(period: int, granularity: str = 'monthly') -> str:
+    """
+    20210801 -> '2021.08' for months, '2021.08.01' for days
+    """
+
+    if granularity == 'monthly':
+        return f'{period // 10000}.{period // 100 % 100:02d}'
+    return f'{period // 10000}.{period // 100 % 100:02d}.{period % 100:02d}'
+
+
+
+def split_periods(periods: list, size: int) -> list:
+    """
+    Cuts planned periods into (start, end) YYYYMMDD string pairs of at most
+    `size` periods each, to fetch a very long range with several requests.
+    """
+
+    return [(str(part[0]), str(part[-1]))
+            for part in (periods[i:i + size] for i in range(0, len(periods), size))]
+
+
+
+def align(periods: list, dates, views, gap='') -> list:
+    """
+    Places views to the columns of `periods` by their dates,
+    periods missing in the response are filled with `gap`.
+    """
+
+    found = dict(zip(dates, views))
+    return [found.get(period, gap) for period in periods]
+
+
+
+# The API sends compact JSON, other layouts go the full parsing way
+_timestamp_pattern = re.compile(rb'"timestamp":"(\d{8})')
+_views_pattern = re.compile(rb'"views":(\d+)')
+_article_pattern = re.compile(rb'"article":("(?:[^"\\]|\\.)*")')
+
+
+def normalize_title(title: str) -> str:
+    """
+    Article title as the pageviews API wants it, the same for any spelling:
+    'Лев_Толстой', 'Лев Толстой' and '%D0%9B%D0%B5%D0%B2_...' give one URL part.
+    """
+
+    title = unquote(title).replace(' ', '_')
+    return quote(title[:1].upper() + title[1:], safe="!$'()*,-.:;@_~")
+
+
+
+def parse_pageviews(body: bytes) -> tuple:
+    """
+    Projects a raw pageviews API response straight to
+    (article, dates, views): dates as YYYYMMDD and views are integer arrays.
+
+    With orjson the bytes go to its native parser and only two fields
+    of each item are kept. Without it the fields are cut out of the bytes
+    by patterns, which is faster than the pure Python json module.
+    Raises ValueError if the body is not a pageviews response.
+
+    """
+
+    if json_loads is json.loads:
+        months = _timestamp_pattern.findall(body)
+        views = _views_pattern.findall(body)
+        if len(months) == len(views) == body.count(b'"timestamp"') and b'"items"' in body:
+            article = _article_pattern.search(body)
+            return (json.loads(article.group(1)) if article else '',
+                    array('l', map(int, months)),
+                    array('q', map(int, views)))
+
+    items = json_loads(body).get('items')
+    if items is None:
+        raise ValueError('No items in response: {!r}'.format(body[:200]))
+
+    return (items[0]['article'] if items else '',
+            array('l', [int(item['timestamp'][:8]) for item in items]),
+            array('q', [item['views'] for item in items]))
+
+
+
+class Checkpoint(object):
+    """
+    Durable progress journal of a harvester kept in a small JSON file.
+    Every save() writes a temporary file, fsyncs it and renames it over
+    the old one, so after a crash the file holds either the previous
+    or the new state, never a torn one.
+
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+
+
+    def load(self) -> dict:
+        """
+        Returns the last saved state, empty dict if there is no checkpoint.
+        """
+
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+
+    def save(self, **state):
+        _tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(_tmp, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(_tmp, self.path)
+
+        _dir = os.open(self.path.parent, os.O_RDONLY)
+        try:
+            os.fsync(_dir)
+        finally:
+            os.close(_dir)
+
+
+    def clear(self):
+        """
+        Removes the checkpoint when the whole run is finished.
+        """
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+
+
+
 class Dataset(object):
     """
     A helper for operating with datasets from SQLite for async requests.
@@ -30,15 +295,33 @@ class Dataset(object):
         self.con = sqlite3.connect(dbname)
         self.con.row_factory = sqlite3.Row # Turn dict mode on
         self.cur = self.con.cursor()
+        apply_scheme(self.cur)
 
         self.count: int = self.con.execute('SELECT Count(*) FROM writers').fetchone()[0]
+        self.table: str = 'writers'  # or 'writers_by_priority', see update_priority()
         self.limit: int = 1
         self.offset: int = 0
         self.order_by: str = 'writer_qid'
         self.fields: str = '*'
         self.distinct: bool = True
 
+        # Keyset (seek) mode: every chunk starts right after the last seen
+        # `order_by` value instead of skipping `offset` rows. `after` is the
+        # resume token, keep it to restart the pass from the same place.
+        self.keyset: bool = False
+        self.after = None
 
+        # Where insert_stat() keeps visits: 'rows' - a row per month in `visits`,
+        # 'series' - a packed array per writer in `series`
+        self.storage: str = 'rows'
+
+        # Fill the summary table once for databases made before it existed
+        if not self.con.execute('SELECT 1 FROM writer_totals LIMIT 1').fetchone():
+            self.update_totals()
+            self.con.commit()
+
+
+    @metrics.timer('sql_seconds', statement='insert_stat')
     def insert_stat(self, stat: list):
         """
         Getting list of lists with dicts, then inserting them into the database.
@@ -46,31 +329,365 @@ class Dataset(object):
 
         if not stat: return None
 
-        query = 'INSERT INTO visits (writer_qid, yearmonth, visits) VALUES (:writer_qid, :yearmonth, :visits)'
+        if self.storage == 'series':
+            try:
+                self._insert_series(stat)
+                self.con.commit()
+            except Exception:
+                self.con.rollback()
+                raise
+            metrics.inc('rows_total', sum(map(len, stat)), table='series')
+            return None
+
+        qids = {row['writer_qid'] for writer in stat for row in writer}
+        query = 'INSERT INTO visits (writer_qid, yearmonth, visits) VALUES (:writer_qid, :yearmonth, :visits) ' + \
+                'ON CONFLICT (writer_qid, yearmonth) DO UPDATE SET visits = excluded.visits'
         try:
             for writer in stat:
                 self.cur.executemany(query, writer)
+            self.update_totals(qids)
             self.con.commit()
         except Exception as e:
+            self.con.rollback()
             print('Inserter error: ', e)
             print('Getting "stat" as ', stat)
+            raise
+        metrics.inc('rows_total', sum(map(len, stat)), table='visits')
+
+
+    @metrics.timer('sql_seconds', statement='update_totals')
+    def update_totals(self, qids=None):
+        """
+        Recounts `writer_totals` rows for the given writers from `visits`,
+        the whole table if qids is None. Doesn't commit.
+        """
+
+        query = 'INSERT OR REPLACE INTO writer_totals (writer_qid, total, average, months, last_month) ' + \
+                'SELECT writer_qid, sum(visits), avg(visits), count(*), max(yearmonth) FROM visits '
+        if qids is None:
+            self.cur.execute(query + 'GROUP BY writer_qid')
+            return None
+
+        qids = list(qids)
+        for start in range(0, len(qids), 500):
+            part = qids[start:start + 500]
+            self.cur.execute(query + 'WHERE writer_qid IN ({}) GROUP BY writer_qid'.format(
+                    ', '.join('?' * len(part))), part)
+
+
+    @metrics.timer('sql_seconds', statement='update_priority')
+    def update_priority(self, sitelinks: dict = None):
+        """
+        Ranks every writer by popularity into the `priority` table, rank 1 first.
+        The score is the average percentile of the signals a writer has:
+        sitelink counts (see sitelink_counts()) and visits total from `writer_totals`.
+        Writers without any signal go last in writer_qid order.
+
+        Walk writers by rank with:
+            ds.table = 'writers_by_priority'
+            ds.order_by = 'priority'
+
+        """
+
+        def percentiles(values: dict) -> dict:
+            # Share of writers with the same or a smaller value, equal values get equal shares
+            ordered = sorted(values.values())
+            return {qid: bisect_right(ordered, value) / len(ordered) for qid, value in values.items()}
+
+        signals = [percentiles(sitelinks or {}), percentiles(dict(self.con.execute(
+                'SELECT writer_qid, total FROM writer_totals').fetchall()))]
+
+        scores = {}
+        for (qid,) in self.con.execute('SELECT DISTINCT writer_qid FROM writers').fetchall():
+            values = [signal[qid] for signal in signals if qid in signal]
+            scores[qid] = sum(values) / len(values) if values else 0.
+
+        ranked = sorted(scores, key=lambda qid: (-scores[qid], qid))
+        try:
+            self.cur.execute('DELETE FROM priority')
+            self.cur.executemany('INSERT INTO priority (writer_qid, rank, score) VALUES (?, ?, ?)',
+                                 ((qid, rank, scores[qid]) for rank, qid in enumerate(ranked, 1)))
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+
+
+    @metrics.timer('sql_seconds', statement='last_months')
+    def last_months(self, qids) -> dict:
+        """
+        Returns {writer_qid: latest stored yearmonth} for the given writers,
+        writers without any visits are not in the result.
+        """
+
+        qids = list(qids)
+        if not qids: return {}
+
+        if self.storage == 'series':
+            return {qid: month_yyyymm(month_index(start) + len(views) - 1) / 100
+                    for qid, (start, views) in self._read_series(qids).items()}
+
+        _marks = ', '.join('?' * len(qids))
+        return dict(self.con.execute(
+                f'SELECT writer_qid, max(yearmonth) FROM visits WHERE writer_qid IN ({_marks}) '
+                'GROUP BY writer_qid', qids).fetchall())
+
+
+    # Series storage: one row per writer in `series` with monthly views packed
+    # into a little-endian int64 blob starting at `start` (YYYYMM), months
+    # without data are zeros. `present` has a byte per month, 1 for months
+    # which were fetched, so totals count the same months as `visits` rows do.
+    # Turned on by Dataset.storage = 'series'.
+
+    def _insert_series(self, stat: list):
+        """
+        Merges fetched months into the packed series of every writer
+        and recounts their `writer_totals` rows over the fetched months only.
+        A series without the mask (packed before it) counts its non-zero months.
+        Doesn't commit.
+
+        """
+
+        fetched = {}
+        for writer in stat:
+            for row in writer:
+                fetched.setdefault(row['writer_qid'], {})[
+                        month_index(round(float(row['yearmonth']) * 100))] = row['visits']
+
+        stored = self._read_series(fetched, mask=True)
+        for qid, months in fetched.items():
+            present = set(months)
+            if qid in stored:
+                start, views, mask = stored[qid]
+                first = month_index(start)
+                present.update(first + n for n, v in enumerate(views)
+                               if (mask[n] if mask is not None else v))
+                months = {**{first + n: v for n, v in enumerate(views)}, **months}
+            first, last = min(months), max(months)
+            views = array('q', (months.get(m, 0) for m in range(first, last + 1)))
+            if sys.byteorder != 'little': views.byteswap()
+            mask = bytes(m in present for m in range(first, last + 1))
+            total = sum(months[m] for m in present)
+
+            self.cur.execute('INSERT OR REPLACE INTO series (writer_qid, start, views, present) '
+                             'VALUES (?, ?, ?, ?)', (qid, month_yyyymm(first), views.tobytes(), mask))
+            self.cur.execute('INSERT OR REPLACE INTO writer_totals '
+                             '(writer_qid, total, average, months, last_month) VALUES (?, ?, ?, ?, ?)',
+                             (qid, total, total / len(present), len(present),
+                              month_yyyymm(last) / 100))
+
+
+    def _read_series(self, qids, mask: bool = False) -> dict:
+        """
+        Returns {writer_qid: (start YYYYMM, array of views)} from `series`,
+        with the presence mask (bytes or None) as the third item if `mask`.
+        """
+
+        result = {}
+        qids = list(qids)
+        for part in (qids[i:i + 500] for i in range(0, len(qids), 500)):
+            for qid, start, blob, present in self.con.execute(
+                    'SELECT writer_qid, start, views, present FROM series WHERE writer_qid IN ({})'.format(
+                        ', '.join('?' * len(part))), part):
+                views = array('q', blob)
+                if sys.byteorder != 'little': views.byteswap()
+                result[qid] = (start, views, present) if mask else (start, views)
+        return result
+
+
+    def load_series(self, qids=None) -> dict:
+        """
+        Returns {writer_qid: (start YYYYMM, numpy int64 array of monthly views)}
+        for the given writers or for all of them. Arrays are read straight
+        from the blobs without copying.
+        """
+
+        import numpy as np
+
+        query = 'SELECT writer_qid, start, views FROM series'
+        if qids is None:
+            rows = self.con.execute(query).fetchall()
+        else:
+            qids, rows = list(qids), []
+            for part in (qids[i:i + 500] for i in range(0, len(qids), 500)):
+                rows += self.con.execute(query + ' WHERE writer_qid IN ({})'.format(
+                            ', '.join('?' * len(part))), part).fetchall()
+        return {qid: (start, np.frombuffer(blob, dtype='<i8')) for qid, start, blob in rows}
+
+
+    def pack_series(self):
+        """
+        Converts everything stored in `visits` rows into `series`.
+        """
+
+        writers = {}
+        for qid, yearmonth, visits in self.con.execute(
+                'SELECT writer_qid, yearmonth, visits FROM visits ORDER BY writer_qid'):
+            writers.setdefault(qid, []).append(
+                    {'writer_qid': qid, 'yearmonth': yearmonth, 'visits': visits})
+            if len(writers) > 1000:
+                last = writers.pop(qid)
+                self._insert_series(list(writers.values()))
+                writers = {qid: last}
+        self._insert_series(list(writers.values()))
+        self.con.commit()
 
 
+    @metrics.timer('sql_seconds', statement='insert_project_stat')
+    def insert_project_stat(self, stat: list):
+        """
+        Like insert_stat() for rows of any project, keeps them in `project_visits`.
+        """
+
+        if not stat: return None
+
+        query = 'INSERT INTO project_visits (writer_qid, project, yearmonth, visits) ' + \
+                'VALUES (:writer_qid, :project, :yearmonth, :visits) ' + \
+                'ON CONFLICT (writer_qid, project, yearmonth) DO UPDATE SET visits = excluded.visits'
+        try:
+            for writer in stat:
+                self.cur.executemany(query, writer)
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+        metrics.inc('rows_total', sum(map(len, stat)), table='project_visits')
+
+
+    def insert_sitelinks(self, links: list):
+        """
+        Keeps (writer_qid, project, article) sitelinks in the `sitelinks` table.
+        """
+
+        if not links: return None
+
+        self.cur.executemany('INSERT OR REPLACE INTO sitelinks (writer_qid, project, article) VALUES (?, ?, ?)',
+                             links)
+        self.con.commit()
+
+
+    def sitelinks(self, qids) -> dict:
+        """
+        Returns {writer_qid: [(project, article), ...]} of the stored sitelinks.
+        """
+
+        result = {}
+        qids = list(qids)
+        for part in (qids[i:i + 500] for i in range(0, len(qids), 500)):
+            for qid, project, article in self.con.execute(
+                    'SELECT writer_qid, project, article FROM sitelinks WHERE writer_qid IN ({}) '
+                    'ORDER BY writer_qid, project'.format(', '.join('?' * len(part))), part):
+                result.setdefault(qid, []).append((project, article))
+        return result
+
+
+    @metrics.timer('sql_seconds', statement='insert_failures')
+    def insert_failures(self, failures: list, target: str = 'visits'):
+        """
+        Keeps rows whose requests failed in the `failures` dead-letter table.
+        Gets list of (row, error) pairs, a repeated failure increases attempts.
+        `target` is the table the replayed rows go to: visits or project_visits.
+
+        """
+
+        if not failures: return None
+
+        query = 'INSERT INTO failures (target, writer_qid, article, error) ' + \
+                'VALUES (:target, :writer_qid, :article, :error) ' + \
+                'ON CONFLICT (target, writer_qid, article) DO UPDATE SET ' + \
+                'error = excluded.error, attempts = attempts + 1, failed_at = CURRENT_TIMESTAMP'
+        self.cur.executemany(query, ({'target': target,
+                                      'writer_qid': row['writer_qid'],
+                                      'article': row['article'],
+                                      'error': str(error)} for row, error in failures))
+        self.con.commit()
+
+
+    def delete_failures(self, rows: list, target: str = 'visits'):
+        """
+        Removes successfully replayed rows from the `failures` table.
+        """
+
+        if not rows: return None
+
+        self.cur.executemany('DELETE FROM failures WHERE target = :target AND '
+                             'writer_qid = :writer_qid AND article = :article',
+                             ({'target': target, 'writer_qid': row['writer_qid'], 'article': row['article']}
+                              for row in rows))
+        self.con.commit()
+
+
+    def failures(self, project: str = None, target: str = 'visits') -> list:
+        """
+        Returns rows of the `failures` table kept for the `target` table to replay them,
+        only articles of the project (ru.wikipedia.org) if it's given.
+        """
+
+        if project is None:
+            return list(map(dict, self.cur.execute(
+                    'SELECT writer_qid, article FROM failures WHERE target = ? ORDER BY writer_qid',
+                    (target,)).fetchall()))
+        return list(map(dict, self.cur.execute(
+                'SELECT writer_qid, article FROM failures WHERE target = ? AND article LIKE ? '
+                'ORDER BY writer_qid', (target, f'https://{project}/%')).fetchall()))
+
+
+    @metrics.timer('sql_seconds', statement='iter_chunk')
     def iter_chunk(self):
         """
         Returns next chunk from database according to self.limit value.
-        Returns None if no next chunk due to self.count value is reached.
+        Returns None if no next chunk due to the end of table is reached.
+
+        In keyset mode rows with the same `order_by` value are never split
+        between two chunks, so a chunk may be slightly longer than the limit.
 
         """
 
+        if self.keyset:
+            return self._iter_chunk_keyset()
+
         _distinct = {False: '', True: 'DISTINCT '}[self.distinct]
-        _query = f'SELECT {_distinct}{self.fields} FROM writers ' + \
+        _query = f'SELECT {_distinct}{self.fields} FROM {self.table} ' + \
                 f'ORDER BY {self.order_by} ' + \
                 f'LIMIT {self.limit} OFFSET {self.offset}'
-        self.offset += self.limit
         if self.offset >= self.count:
             return None
-        return list(map(dict, self.cur.execute(_query).fetchall()))
+        self.offset += self.limit
+        return list(map(dict, self.cur.execute(_query).fetchall())) or None
+
+
+    def _iter_chunk_keyset(self):
+        """
+        Seeks the upper bound of the next chunk through the index,
+        then takes all rows between the resume token and that bound.
+
+        """
+
+        _after = '' if self.after is None else f'WHERE {self.order_by} > :after '
+        _bound = self.con.execute(
+                f'SELECT {self.order_by} FROM {self.table} {_after}' + \
+                f'ORDER BY {self.order_by} LIMIT 1 OFFSET :skip',
+                {'after': self.after, 'skip': self.limit - 1}
+            ).fetchone()
+
+        _where = []
+        if self.after is not None:
+            _where.append(f'{self.order_by} > :after')
+        if _bound is not None:
+            _where.append(f'{self.order_by} <= :bound')
+        _where = ('WHERE ' + ' AND '.join(_where) + ' ') if _where else ''
+
+        _distinct = {False: '', True: 'DISTINCT '}[self.distinct]
+        _query = f'SELECT {_distinct}{self.fields}, {self.order_by} AS _key FROM {self.table} ' + \
+                _where + f'ORDER BY {self.order_by}'
+        rows = self.cur.execute(_query, {'after': self.after,
+                                         'bound': _bound[0] if _bound else None}).fetchall()
+        if not rows:
+            return None
+
+        self.after = rows[-1]['_key']
+        self.offset += len(rows)
+        return [{k: row[k] for k in row.keys() if k != '_key'} for row in rows]
 
 
     def close(self):
@@ -90,20 +707,58 @@ class Person(object):
     Provides SQLite3 table values from CSV file with correct data types and right format.
     The tables are stored in `scheme.sql` file in the script's directory.
 
+    All values are converted once in the constructor and kept in slots,
+    `Person.fields` lists the table columns in the order of `astuple()`.
+
     """
 
+    fields = ('writer_qid', 'writer', 'birthdate', 'deathdate',
+              'birthplace_qid', 'birthplace', 'geo_lat', 'geo_lon',
+              'ethnicity_qid', 'ethnicity', 'language_qid', 'language', 'article')
+
+    __slots__ = fields
+
+    _values = attrgetter(*fields)
+    _qid_pattern = re.compile(r"^http.+Q(\d+)$")
+
     def __init__(self, person: dict):
-        self._person = person
-        self._geo = person.get('geo','')[6:-1].split()
+        get = person.get
+        chew = self._chew_qid
+
+        self.writer_qid: int = chew(get('item', ''))
+        self.writer: str = str(get('itemLabel', 'Undefined'))
+        self.birthdate = self._parse_data(get('birthdate', ''))
+        self.deathdate = self._parse_data(get('deathdate', ''))
+        self.birthplace_qid: int = chew(get('bplace', ''))
+        self.birthplace: str = str(get('bplaceLabel', 'Undefined'))
+
+        _geo = get('geo', '')[6:-1].split()
+        self.geo_lat: float = float(_geo[0]) if _geo and _geo[0] else .0
+        self.geo_lon: float = float(_geo[1]) if len(_geo) > 1 and _geo[1] else .0
+
+        self.ethnicity_qid: int = chew(get('ethnicity'))
+        self.ethnicity: str = str(get('ethnicityLabel', 'Undefined'))
+        self.language_qid: int = chew(get('lang', ''))
+        self.language: str = str(get('langLabel', ''))
+        self.article: str = str(get('article', ''))
+
+
+    def astuple(self) -> tuple:
+        return self._values(self)
+
 
+    def asdict(self) -> dict:
+        return {field: getattr(self, field) for field in self.fields}
 
-    def _chew_qid(self, bite: str) -> int:
+
+    @classmethod
+    def _chew_qid(cls, bite: str) -> int:
         """
         Returns last digits after "/Q" from urls like http://www.wikidata.org/.../Q315279
         """
 
-        _qid = re.findall(r"^http.+Q(\d+)$", bite)
-        return int(_qid[-1]) if _qid else -1
+        _qid = cls._qid_pattern.match(bite) if bite else None
+        return int(_qid.group(1)) if _qid else -1
 
 
     def _parse_data(self, date_: str):
@@ -112,70 +767,23 @@ class Person(object):
         Returns None if the date is not presented or 'UNKNOWN VALUE'
         in case of unknown value format.
 
+        Wikidata always gives 'YYYY-MM-DDTHH:MM:SSZ', so the string is cut
+        by positions instead of going through strptime().
+
         """
 
         if not date_: return None
         try:
-            _date_parsed = datetime.strptime(date_, '%Y-%m-%dT%H:%M:%SZ')
+            if len(date_) != 20 or date_[4] != '-' or date_[7] != '-' \
+                    or date_[10] != 'T' or date_[13] != ':' or date_[16] != ':' or date_[19] != 'Z':
+                raise ValueError(date_)
+            _date_parsed = datetime(int(date_[0:4]), int(date_[5:7]), int(date_[8:10]),
+                                    int(date_[11:13]), int(date_[14:16]), int(date_[17:19]))
         except ValueError:
             print ('{}, {}. Date value error: {}'.format(self.writer_qid, self.writer, date_))
             return 'UNKNOWN VALUE'
         return _date_parsed
 
-    @property
-    def writer_qid(self) -> int:
-        return self._chew_qid(self._person.get('item', ''))
-
-    @property
-    def writer(self) -> str:
-        return str(self._person.get('itemLabel', 'Undefined'))
-
-    @property
-    def birthdate(self):
-        return self._parse_data(self._person.get('birthdate', ''))
-
-    @property
-    def deathdate(self):
-        return self._parse_data(self._person.get('deathdate', ''))
-
-    @property
-    def birthplace_qid(self) -> int:
-        return self._chew_qid(self._person.get('bplace', ''))
-
-    @property
-    def birthplace(self) -> str:
-        return str(self._person.get('bplaceLabel', 'Undefined'))
-
-    @property
-    def geo_lat(self) -> float:
-        _lat = self._geo[0] if self._geo else None
-        return float(_lat) if _lat else .0
-
-    @property
-    def geo_lon(self) -> float:
-        _lon = self._geo[1] if self._geo else None
-        return float(_lon) if _lon else .0
-
-    @property
-    def ethnicity_qid(self) -> int:
-        return self._chew_qid(self._person.get('ethnicity'))
-
-    @property
-    def ethnicity(self) -> str:
-        return str(self._person.get('ethnicityLabel', 'Undefined'))
-
-    @property
-    def language_qid(self) -> int:
-        return self._chew_qid(self._person.get('lang', ''))
-
-    @property
-    def language(self) -> str:
-        return str(self._person.get('langLabel', ''))
-
-    @property
-    def article(self) -> str:
-        return str(self._person.get('article', ''))
-
 
 
 
@@ -196,12 +804,11 @@ class Database(object):
         """
 
         sqlite3.paramstyle = 'named'
-        with open(pathlib.Path(__file__).parent / 'scheme.sql', 'r') as scheme:
-            sql_query = scheme.read()
 
         self.con = sqlite3.connect(dbname)
         self.cur = self.con.cursor()
-        [self.cur.execute(query) for query in sql_query.split('\n;\n')] # create tables if necessary
+        apply_scheme(self.cur) # create tables if necessary
+        self._statements = {}
 
 
     def cursor(self) -> sqlite3.Cursor:
@@ -209,11 +816,66 @@ class Database(object):
 
 
     def insert_writer(self, table_row: dict):
-        _sql_request = '''INSERT INTO writers ({}) VALUES ({})'''.format(
-                ', '.join(table_row),
-                ', '.join(f':{i}' for i in table_row)
-            )
-        self.cur.execute(_sql_request, table_row)
+        self.cur.execute(self._insert_sql('writers', tuple(table_row)), table_row)
+
+
+    def _insert_sql(self, table: str, fields: tuple, named: bool = True) -> str:
+        """
+        Returns INSERT statement for the fields, formatted once per fields set.
+        Named placeholders are for dict rows, positional ones for tuples.
+        """
+
+        _sql = self._statements.get((table, fields, named))
+        if _sql is None:
+            _sql = '''INSERT INTO {} ({}) VALUES ({})'''.format(
+                    table,
+                    ', '.join(fields),
+                    ', '.join(f':{i}' if named else '?' for i in fields)
+                )
+            self._statements[(table, fields, named)] = _sql
+        return _sql
+
+
+    def tune(self, cache_mb: int = 64):
+        """
+        Pragmas for bulk loading: write-ahead log, no fsync on every commit,
+        bigger page cache and temp tables in memory.
+        """
+
+        self.con.execute('PRAGMA journal_mode = WAL')
+        self.con.execute('PRAGMA synchronous = NORMAL')
+        self.con.execute(f'PRAGMA cache_size = {-cache_mb * 1024}')
+        self.con.execute('PRAGMA temp_store = MEMORY')
+
+
+    @metrics.timer('sql_seconds', statement='bulk_insert')
+    def bulk_insert(self, rows, fields, table: str = 'writers', batch: int = 10000) -> int:
+        """
+        Inserts rows from any iterable (a generator is fine) with executemany(),
+        one transaction per `batch` rows. The statement is prepared once.
+        Returns number of inserted rows.
+
+        Parameters:
+        rows          Iterable of dicts with `fields` keys or tuples in `fields` order
+        fields        Table columns to fill
+        table: str    Table name
+        batch: int    Rows per transaction
+
+        """
+
+        rows = iter(rows)
+        total = 0
+
+        while True:
+            chunk = list(islice(rows, batch))
+            if not chunk: break
+            _sql = self._insert_sql(table, tuple(fields), not isinstance(chunk[0], tuple))
+            with self.con:  # BEGIN ... COMMIT, ROLLBACK on error
+                self.cur.executemany(_sql, chunk)
+            total += len(chunk)
+            metrics.inc('rows_total', len(chunk), table=table)
+
+        return total
 
 
     def commit(self):
@@ -228,64 +890,502 @@ class Database(object):
 
 
 
+class FetchError(Exception):
+    """
+    Request failed after all retries or with a non-retryable status.
+    `status` is the HTTP status if the server answered at all.
+
+    """
+
+    def __init__(self, message: str, url: str, status: int = None):
+        super().__init__(message)
+        self.url = url
+        self.status = status
+
+
+
+class CacheMiss(FetchError):
+    """
+    Answer is not in the offline ResponseCache. Nothing failed,
+    the request was just not made, so it's never dead-lettered.
+
+    """
+
+
+
+
+
+class RateLimiter(object):
+    """
+    Token bucket: lets `rate` requests per second through on average,
+    with bursts up to `burst` requests.
+
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+    def pause(self, seconds: float):
+        """
+        Drains the bucket for `seconds`, e.g. when the server sent Retry-After.
+        """
+
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+
+
+
+class AdaptiveLimit(object):
+    """
+    Window of requests in flight driven by AIMD, like TCP congestion control:
+    every fast success adds 1 / window (about +1 per window of answers),
+    429, timeouts and answers much slower than usual cut the window
+    by `decrease`, not more often than once a second. A fast 5xx neither
+    cuts nor grows it: random server errors are not a sign of load.
+
+    Used by Client(adaptive=True) instead of a fixed semaphore.
+
+    """
+
+    def __init__(self, limit: int, minimum: int = 1, decrease: float = .5,
+                 tolerance: float = 3., latency: float = None):
+        """
+        Parameters:
+        limit: int          Max window, the connection pool size
+        minimum: int        Window never goes below it
+        decrease: float     Window multiplier on congestion
+        tolerance: float    Answer slower than the average latency this many times is congestion
+        latency: float      Fixed latency limit in seconds instead of the baseline one
+
+        """
+
+        self.limit = limit
+        self.minimum = minimum
+        self.window = float(max(minimum, limit // 4))
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.latency = latency
+        self.in_flight = 0
+        self._baseline = None
+        self._cut = 0.
+        self._condition = asyncio.Condition()
+
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.window))
+            self.in_flight += 1
+
+
+    async def __aexit__(self, *exc):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+
+    def observe(self, elapsed: float, congested: bool = False, failed: bool = False):
+        """
+        Takes the outcome of a request: its time, whether the server pushed back
+        (429, timeout) and whether it failed otherwise (5xx).
+        """
+
+        if not congested:
+            # Baseline is the moving average of answer times
+            if self._baseline is None:
+                self._baseline = elapsed
+            congested = elapsed > (self.latency or self._baseline * self.tolerance)
+            self._baseline += (elapsed - self._baseline) * .05
+
+        if congested:
+            now = time.monotonic()
+            if now - self._cut >= 1:
+                self._cut = now
+                self.window = max(self.minimum, self.window * self.decrease)
+        elif not failed:
+            self.window = min(self.limit, self.window + 1 / self.window)
+
+
+
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of GET responses, one file per request URL named
+    by the SHA-256 of the URL: <directory>/ab/abcd....<status>.
+    Only 200 and 404 answers are kept.
+
+    Answers whose last requested period ended more than `lag` seconds ago
+    (pageviews of a month are published some days after it) never expire,
+    others (and 404s, an article may appear) live `ttl` seconds.
+    With `offline` the network is never used: Client serves recorded
+    answers at full speed and a miss is a CacheMiss.
+
+    """
+
+    statuses = (200, 404)
+    _dates_pattern = re.compile(r'/(\d{8})\d{0,2}(?=/|$)')
+
+    def __init__(self, directory, ttl: float = 86400, offline: bool = False, lag: float = 7 * 86400):
+        self.directory = pathlib.Path(directory)
+        self.ttl = ttl
+        self.lag = lag
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+
+
+    def _path(self, url: str, status: int) -> pathlib.Path:
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return self.directory / key[:2] / f'{key}.{status}'
+
+
+    def immutable(self, url: str) -> bool:
+        """
+        True if the last period the URL asks for (a day for daily URLs,
+        the month of the end date otherwise) ended at least `lag` seconds ago.
+        """
+
+        dates = self._dates_pattern.findall(url)
+        if not dates: return False
+
+        end = datetime.strptime(dates[-1], '%Y%m%d')
+        if '/daily/' in url:
+            end += timedelta(days=1)
+        else:
+            end = (end.replace(day=1) + timedelta(days=32)).replace(day=1)
+        return datetime.now() - end >= timedelta(seconds=self.lag)
+
+
+    def get(self, url: str):
+        """
+        Returns (status, body) of the recorded answer or None.
+        """
+
+        for status in self.statuses:
+            path = self._path(url, status)
+            try:
+                with open(path, 'rb') as f:
+                    if not self.offline and (status != 200 or not self.immutable(url)) and \
+                            time.time() - os.fstat(f.fileno()).st_mtime > self.ttl:
+                        continue
+                    body = f.read()
+            except FileNotFoundError:
+                continue
+            self.hits += 1
+            return status, body
+
+        self.misses += 1
+        return None
+
+
+    def put(self, url: str, status: int, body: bytes):
+        if status not in self.statuses: return None
+
+        path = self._path(url, status)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _tmp = path.with_name(path.name + '.tmp')
+        with open(_tmp, 'wb') as f:
+            f.write(body)
+        os.replace(_tmp, path)
+
+
+
+
+
+class Client(object):
+    """
+    Keeps one keep-alive aiohttp session with a connection pool for the whole run.
+    Concurrency of all requests made through the client is limited by `limit`.
+
+    Usage:
+        async with Client(limit=90) as client:
+            await Statistics(row, client=client).async_wikistat()
+
+    With a ResponseCache answers already on disk are served without the network.
+
+    """
+
+    headers = {'Api-User-Agent' : 'Scientific literature project (trankov@gmail.com)'}
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, limit: int = 90, headers: dict = None,
+                 rate: float = None, retries: int = 5, backoff: float = 1.0,
+                 cache: ResponseCache = None, adaptive: bool = False, memo: int = 10000):
+        """
+        Parameters:
+        limit: int      Max number of simultaneous requests
+        headers: dict   Session headers, Api-User-Agent by default
+        rate: float     Max requests per second, no limit if None
+        retries: int    Extra attempts for 429, 5xx, timeouts and broken JSON
+        backoff: float  First retry delay in seconds, doubled with every attempt
+        cache           ResponseCache to read and record answers, None - always network
+        adaptive: bool  Tune requests in flight up to `limit` at runtime, see AdaptiveLimit
+        memo: int       Answers kept for repeated requests, 0 - share requests in flight only
+
+        """
+
+        self.limit = limit
+        self._headers = headers or self.headers
+        self._session = None
+        self._semaphore = None
+        self.limiter = RateLimiter(rate, burst=limit) if rate else None
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self.adaptive = adaptive
+        self.memo = memo
+        self.coalesced = 0  # requests answered without a download of their own
+        self._pending = {}
+        self._answers = OrderedDict()
+
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit,
+                                         ttl_dns_cache=3600)
+        timeout = aiohttp.ClientTimeout(total=180, connect=10, sock_connect=10, sock_read=10)
+        self._session = aiohttp.ClientSession(connector=connector, headers=self._headers,
+                                              trust_env=True, timeout=timeout)
+        self._semaphore = AdaptiveLimit(self.limit) if self.adaptive else asyncio.Semaphore(self.limit)
+
+
+    @property
+    def window(self) -> float:
+        """
+        Requests allowed in flight right now.
+        """
+
+        return self._semaphore.window if self.adaptive else self.limit
+
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+    async def get_json(self, url: str):
+        """
+        Returns decoded JSON of the GET request, see get().
+        """
+
+        return await self.get(url, json_loads)
+
+
+    async def get_pageviews(self, url: str) -> tuple:
+        """
+        Returns pageviews response projected by parse_pageviews(), see get().
+        """
+
+        return await self.get(url, parse_pageviews)
+
+
+    async def get(self, url: str, decode):
+        """
+        Returns decode(body) of the GET request, see _get().
+        Equal requests share one download: a request already in flight is awaited,
+        a recently finished one is answered from memory (the last `memo` answers).
+        Answers are shared, so they must not be changed by the caller.
+
+        """
+
+        key = (url, decode)
+        if key in self._answers:
+            self._answers.move_to_end(key)
+            self.coalesced += 1
+            metrics.inc('http_coalesced_total', source='memo')
+            return self._answers[key]
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            metrics.inc('http_coalesced_total', source='in_flight')
+            return await asyncio.shield(pending)
+
+        pending = self._pending[key] = asyncio.ensure_future(self._get(url, decode))
+        try:
+            result = await asyncio.shield(pending)
+        finally:
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+
+        if self.memo:
+            self._answers[key] = result
+            if len(self._answers) > self.memo:
+                self._answers.popitem(last=False)
+        return result
+
+
+    async def _get(self, url: str, decode):
+        """
+        Returns decode(body) of the GET request, body is raw bytes.
+        Throttling, server errors, timeouts and undecodable bodies are retried
+        with jittered exponential backoff, honouring the Retry-After header.
+        Raises FetchError when attempts are over or the status is not retryable,
+        CacheMiss when an offline cache has no answer.
+
+        """
+
+        if self.cache is not None:
+            cached = self.cache.get(url)
+            metrics.inc('cache_total', result='miss' if cached is None else 'hit')
+            if cached is not None:
+                status, body = cached
+                if status != 200:
+                    raise FetchError(f'HTTP {status}', url, status)
+                try:
+                    return decode(body)
+                except (ValueError, KeyError) as e:
+                    raise FetchError(f'Cached {type(e).__name__}: {e}', url, status) from e
+            if self.cache.offline:
+                raise CacheMiss('Not in the offline cache', url)
+
+        for attempt in range(self.retries + 1):
+            status, delay = None, None
+            try:
+                if self.limiter is not None:
+                    await self.limiter.acquire()
+                async with self._semaphore:
+                    started = time.monotonic()
+                    async with self._session.get(url) as response:
+                        status = response.status
+                        body = await response.read()
+                        elapsed = time.monotonic() - started
+                        metrics.observe('http_request_seconds', elapsed, status=status)
+                        if self.adaptive:
+                            self._semaphore.observe(elapsed, status == 429, status in self.retry_statuses)
+                        if status == 200:
+                            result = decode(body)
+                            if self.cache is not None:
+                                self.cache.put(url, status, body)
+                            return result
+                        if status not in self.retry_statuses:
+                            if self.cache is not None:
+                                self.cache.put(url, status, body)
+                            raise FetchError(f'HTTP {status}', url, status)
+                        delay = self._retry_after(response.headers.get('Retry-After'))
+                        error = f'HTTP {status}'
+            except FetchError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                error = f'{type(e).__name__}: {e}'
+                metrics.inc('http_errors_total', error=type(e).__name__)
+                if self.adaptive and not isinstance(e, (ValueError, KeyError)):
+                    self._semaphore.observe(0, congested=True)
+
+            if attempt == self.retries:
+                break
+            if delay is None:
+                delay = self.backoff * 2 ** attempt * random.uniform(.5, 1.5)
+            elif self.limiter is not None:
+                self.limiter.pause(delay)
+            await asyncio.sleep(delay)
+
+        raise FetchError(error, url, status)
+
+
+    @staticmethod
+    def _retry_after(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+
+
+
+
 class Statistics(object):
     """
     Provides access to wikipedia article statistics.
-    Requires a dict object with k/v pairs of a current Dataset row item.
+    Requires a dict object with k/v pairs of a current Dataset row item,
+    the project (ru.wikipedia.org, en.wikiquote.org...) comes from the article URL.
 
     """
 
+    # Change to send requests elsewhere, e.g. to fakeapi.py
+    api = 'https://wikimedia.org/api/rest_v1/metrics'
+
     def __init__(self,
                  dataset: dict,
                  startdate: str = datetime.strftime(datetime.now() - timedelta(days=730), '%Y%m01'),
-                 enddate: str = datetime.strftime(datetime.now(), '%Y%m01')
+                 enddate: str = datetime.strftime(datetime.now(), '%Y%m01'),
+                 client: Client = None
                 ):
 
+        # Any project's article URL works: https://ru.wikiquote.org/wiki/...
+        self.project, _, self._article = dataset['article'].partition('://')[2].partition('/wiki/')
+        self._article = normalize_title(self._article)
+
         self._template = \
-                'https://wikimedia.org/api/rest_v1/metrics' + \
-                '/pageviews/per-article/ru.wikipedia.org' + \
+                self.api + \
+               f'/pageviews/per-article/{self.project}' + \
                 '/all-access/user/{}/monthly/' + \
                f'{startdate}/{enddate}'  # should be like '20210601/20210701'
 
-        self._article = dataset['article'][30:]
         self._wqid = dataset['writer_qid']
+        self._client = client
+        self.error = None  # FetchError worth to retry later, see Dataset.insert_failures()
+        self.missed = False  # not in the offline cache, neither stored nor an error
 
 
     async def async_wikistat(self):
 
         url = self._template.format(self._article)
-        connector = aiohttp.TCPConnector(limit_per_host = 90)
-        timeout = aiohttp.ClientTimeout(total=180, connect=10, sock_connect=10, sock_read=10)
-        headers = {'Api-User-Agent' : 'Scientific literature project (trankov@gmail.com)'}
 
-        async with aiohttp.ClientSession(connector=connector, headers=headers,
-                                         trust_env=True, timeout=timeout) as session:
-            try:
-                response = await session.get(url)
-                result = await response.text(encoding='utf-8')
-            except Exception as e:
-                print ('\nError in request: ', e, '\n', url, sep='')
-                return None
+        self.error = None
+        self.missed = False
 
         try:
-            jsn_result = json.loads(result)
-        except Exception as e:
-            print ('\nJSON parse error: ', e)
-            print (result)
+            if self._client is not None:
+                _, dates, views = await self._client.get_pageviews(url)
+            else:
+                async with Client(limit=1) as client:
+                    _, dates, views = await client.get_pageviews(url)
+        except CacheMiss:
+            self.missed = True
+            metrics.inc('articles_total', result='uncached')
             return None
-
-        if 'items' not in jsn_result:
-            print ('Returned unexpected response: ', jsn_result)
+        except FetchError as e:
+            if e.status != 404:
+                self.error = e
+            metrics.inc('articles_total', result='missing' if e.status == 404 else 'failed')
+            print ('\nError in request: ', e, '\n', url, sep='')
             return None
 
-        try:
-            return [
-                {
-                    'writer_qid' : self._wqid,
-                    'yearmonth' : f"{int(x['timestamp'][:6])*.01:.2f}", # 20210801 -> 2021.08
-                    'visits' : x['views']
-                } for x in jsn_result['items']
-            ]
-        except Exception as e:
-            print ('\nError during parsing response: ', e, '\nURL: ', url)
-            return None
+        metrics.inc('articles_total', result='ok')
+
+        return [
+            {
+                'writer_qid' : self._wqid,
+                'project' : self.project,
+                'yearmonth' : f"{date // 100 * .01:.2f}", # 20210801 -> 2021.08
+                'visits' : visits
+            } for date, visits in zip(dates, views)
+        ]
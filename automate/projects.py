@@ -0,0 +1,151 @@
+# Pageviews of writers across Wikimedia projects.
+# Every writer fans out to all of its sitelinks (Wikipedia, Wikiquote, Wikisource
+# in any language), all requests of the run share one Client and its connection pool,
+# visits are kept by project in `project_visits`.
+#
+# python projects.py            - walk writers
+# python projects.py replay     - refetch failed requests only
+
+import sys
+import pathlib
+import asyncio
+
+from metrics import metrics
+from models import Dataset, Client, Checkpoint, FetchError, ResponseCache
+from getstats import Watermark, produce, fetch, consume
+
+
+# Project families to harvest, the second level of the project domain
+FAMILIES = ('wikipedia', 'wikiquote', 'wikisource')
+
+WIKIDATA = 'https://www.wikidata.org/w/api.php?action=wbgetentities' + \
+           '&props=sitelinks/urls&format=json&ids={}'
+
+
+
+async def fetch_sitelinks(client: Client, qids: list, families: tuple = FAMILIES) -> list:
+    """
+    Returns (writer_qid, project, article URL) of every sitelink of the writers
+    in the given project families, asks Wikidata for 50 entities per request.
+    """
+
+    links = []
+    for start in range(0, len(qids), 50):
+        ids = '|'.join(f'Q{qid}' for qid in qids[start:start + 50])
+        response = await client.get_json(WIKIDATA.format(ids))
+        for entity in response.get('entities', {}).values():
+            if 'missing' in entity: continue
+            qid = int(entity['id'][1:])
+            for sitelink in entity.get('sitelinks', {}).values():
+                project = sitelink['url'].partition('://')[2].partition('/')[0]
+                if project.rsplit('.', 2)[-2] in families:
+                    links.append((qid, project, sitelink['url']))
+    return links
+
+
+
+async def produce_sitelinks(ds: Dataset, client: Client, rows: asyncio.Queue,
+                            watermark: Watermark, workers: int, families: tuple):
+    """
+    Streams one row per sitelink of every writer of the Dataset into the queue.
+    Sitelinks are asked from Wikidata once and kept in the `sitelinks` table.
+
+    Writers whose sitelinks request failed are held in the Watermark, so the
+    resume key doesn't pass them, and asked once more at the end of the pass.
+    If that fails too, the run stops with the checkpoint still before them.
+
+    """
+
+    async def put(qid, links):
+        for project, article in links:
+            watermark.push(qid)
+            await rows.put({'writer_qid': qid, 'article': article})
+
+    deferred = []
+
+    for chunk in iter(ds.iter_chunk, None):
+        qids = list(dict.fromkeys(item['writer_qid'] for item in chunk))
+        known = ds.sitelinks(qids)
+        missing = [qid for qid in qids if qid not in known]
+        if missing:
+            try:
+                links = await fetch_sitelinks(client, missing, families)
+            except FetchError as e:
+                print ('\nError in request, retry at the end: ', e, '\n', e.url, sep='')
+                for qid in missing:
+                    watermark.push(qid)
+                deferred.extend(missing)
+                links = []
+            ds.insert_sitelinks(links)
+            for qid, project, article in links:
+                known.setdefault(qid, []).append((project, article))
+
+        for qid in qids:
+            await put(qid, known.get(qid, ()))
+
+    if deferred:
+        links = await fetch_sitelinks(client, deferred, families)
+        ds.insert_sitelinks(links)
+        known = {}
+        for qid, project, article in links:
+            known.setdefault(qid, []).append((project, article))
+        for qid in deferred:
+            await put(qid, known.get(qid, ()))
+            watermark.done(qid)
+
+    for _ in range(workers):
+        await rows.put(None)
+
+
+
+async def harvest(ds: Dataset, concurrency: int = 90, batch: int = 500, rate: float = None,
+                  replay: bool = False, families: tuple = FAMILIES,
+                  checkpoint: Checkpoint = None, cache: ResponseCache = None):
+    """
+    Fetches pageviews of all sitelinks of the writers in one pass,
+    the pipeline and the resume key are the same as in getstats.iter_writers().
+    """
+
+    rows = asyncio.Queue(maxsize=concurrency * 2)
+    results = asyncio.Queue(maxsize=batch * 2)
+    watermark = Watermark(ds.after)
+
+    async with Client(limit=concurrency, rate=rate, cache=cache) as client:
+        producer = produce(ds, rows, watermark, concurrency, True, False, None,
+                           target='project_visits') if replay else \
+                   produce_sitelinks(ds, client, rows, watermark, concurrency, families)
+        await asyncio.gather(
+            producer,
+            consume(ds, results, watermark, concurrency, batch, replay, checkpoint,
+                    store=ds.insert_project_stat, target='project_visits'),
+            *(fetch(client, rows, results) for _ in range(concurrency))
+        )
+
+    if checkpoint is not None:
+        checkpoint.clear()
+
+    print()
+    return watermark.key
+
+
+
+if __name__ == '__main__':
+
+    metrics.install(pathlib.Path(__file__).parent / 'projects.metrics.json')
+
+    ds = Dataset(pathlib.Path(__file__).parent / 'writers_list2.sqlite3')
+    ds.fields = 'writer_qid'
+    ds.limit = 50
+    ds.keyset = True
+
+    replay = sys.argv[1:2] == ['replay']
+    checkpoint = None if replay else Checkpoint(pathlib.Path(__file__).parent / 'projects.checkpoint.json')
+    if checkpoint is not None:
+        ds.after = checkpoint.load().get('after')
+
+    cache = ResponseCache(pathlib.Path(__file__).parent / 'cache')
+
+    asyncio.run(harvest(ds, concurrency=90, rate=90, replay=replay, checkpoint=checkpoint, cache=cache))
+
+    ds.commit()
+    ds.close()
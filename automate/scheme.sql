@@ -18,6 +18,9 @@ CREATE TABLE IF NOT EXISTS writers
     )
 ;
 
+CREATE INDEX IF NOT EXISTS writers_writer_qid ON writers (writer_qid)
+;
+
 CREATE TABLE IF NOT EXISTS visits
     (
         id              INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -27,6 +30,77 @@ CREATE TABLE IF NOT EXISTS visits
     )
 ;
 
+CREATE UNIQUE INDEX IF NOT EXISTS visits_writer_month ON visits (writer_qid, yearmonth)
+;
+
+CREATE TABLE IF NOT EXISTS priority
+    (
+        writer_qid      INTEGER PRIMARY KEY,
+        rank            INTEGER NOT NULL,
+        score           REAL NOT NULL
+    )
+;
+
+CREATE UNIQUE INDEX IF NOT EXISTS priority_rank ON priority (rank)
+;
+
+CREATE VIEW IF NOT EXISTS writers_by_priority AS
+    SELECT writers.*, priority.rank AS priority
+    FROM priority JOIN writers ON writers.writer_qid = priority.writer_qid
+;
+
+CREATE TABLE IF NOT EXISTS sitelinks
+    (
+        writer_qid      INTEGER NOT NULL,
+        project         TEXT NOT NULL,
+        article         TEXT NOT NULL,
+        UNIQUE (writer_qid, project)
+    )
+;
+
+CREATE TABLE IF NOT EXISTS project_visits
+    (
+        id              INTEGER PRIMARY KEY AUTOINCREMENT,
+        writer_qid      INTEGER NOT NULL,
+        project         TEXT NOT NULL,
+        yearmonth       REAL NOT NULL,
+        visits          INTEGER NOT NULL,
+        UNIQUE (writer_qid, project, yearmonth)
+    )
+;
+
+CREATE TABLE IF NOT EXISTS series
+    (
+        writer_qid      INTEGER PRIMARY KEY,
+        start           INTEGER NOT NULL,
+        views           BLOB NOT NULL,
+        present         BLOB
+    )
+;
+
+CREATE TABLE IF NOT EXISTS writer_totals
+    (
+        writer_qid      INTEGER PRIMARY KEY,
+        total           INTEGER NOT NULL,
+        average         REAL NOT NULL,
+        months          INTEGER NOT NULL,
+        last_month      REAL NOT NULL
+    )
+;
+
+CREATE TABLE IF NOT EXISTS writer_analytics
+    (
+        writer_qid      INTEGER PRIMARY KEY,
+        trend           REAL,
+        yoy             REAL,
+        peak_month      INTEGER,
+        seasonality     REAL,
+        rank            INTEGER,
+        rank_change     INTEGER,
+        percentile      REAL
+    )
+;
+
 CREATE TABLE IF NOT EXISTS ratings
     (
         id              INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -34,3 +108,15 @@ CREATE TABLE IF NOT EXISTS ratings
         writer_qid      INTEGER NOT NULL,
         rating          REAL NOT NULL
     )
+;
+
+CREATE TABLE IF NOT EXISTS failures
+    (
+        target          TEXT NOT NULL DEFAULT 'visits',
+        writer_qid      INTEGER NOT NULL,
+        article         TEXT NOT NULL,
+        error           TEXT NOT NULL,
+        attempts        INTEGER NOT NULL DEFAULT 1,
+        failed_at       TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (target, writer_qid, article)
+    )
@@ -5,121 +5,488 @@
 
 import asyncio
 import time
-import random
+import os
+import sys
+import socket
+import argparse
+
+from multiprocessing import Process
 
-import aiohttp
 import psycopg2 # Библиотека для работы с PostgreSQL
-import orjson   # Сторонний JSON-движок, раз уж он тут и так установлен,
-                # но в данном скрипте можно и родной (ответы по статистике
-                # приходят в json)
 
+# Ответы по статистике приходят в json. Разбирает их models.parse_pageviews(),
+# если установлен orjson, то при необходимости полного разбора - им.
+from models import Client, FetchError, CacheMiss, Checkpoint, ResponseCache, sitelink_counts
+from models import plan_periods, period_label, split_periods, align, normalize_title
+from metrics import metrics
+
+
+
+# Это главный URL-запрос к Wikimedia Stat API.
+#
+# 1. project - в какой вики ищем: en.wikipedia.org, ru.wikipedia.org и т.д.
+#
+# 2. granularity - monthly, если запрашиваем данные по месяцам, daily - по дням.
+#
+# 3. start и end - дата начала и дата конца временного промежутка
+#    в формате ГГГГММДД, оба включительно.
+#
+# Колонки CSV строятся из этих дат сами (models.plan_periods), каждый ответ
+# раскладывается по своим колонкам, а пропущенные месяцы остаются пустыми.
+# Всё это задаётся ключами командной строки, см. python statistics.py --help
+
+URL = "https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/{project}/all-access/user/{article}/{granularity}/{start}/{end}"
 
+project = 'en.wikipedia.org'
+granularity = 'monthly'
+start, end = '20150701', '20210701'
 
-# Это хардкодинг, т.к. по ТЗ не предполагалось дальнейшей смены диапазонов.
-# Если в REST-запросе будете добавлять данные, допишите колонки здесь.
-# Ну или потом можно функцию дописать. Если будет на то смысл заморачиваться.
+# Не больше стольких периодов в одном запросе: длинный дневной ряд
+# режется на несколько запросов, они идут параллельно и склеиваются.
+split = 366
 
-MONTHS = '"2015.07","2015.08","2015.09","2015.10","2015.11","2015.12","2016.01","2016.02","2016.03","2016.04","2016.05","2016.06","2016.07","2016.08","2016.09","2016.10","2016.11","2016.12","2017.01","2017.02","2017.03","2017.04","2017.05","2017.06","2017.07","2017.08","2017.09","2017.10","2017.11","2017.12","2018.01","2018.02","2018.03","2018.04","2018.05","2018.06","2018.07","2018.08","2018.09","2018.10","2018.11","2018.12","2019.01","2019.02","2019.03","2019.04","2019.05","2019.06","2019.07","2019.08","2019.09","2019.10","2019.11","2019.12","2020.01","2020.02","2020.03","2020.04","2020.05","2020.06","2020.07","2020.08","2020.09","2020.10","2020.11","2020.12","2021.01","2021.02","2021.03","2021.04","2021.05","2021.06","2021.07"'
+periods = plan_periods(start, end, granularity)
 
+# Кэш ответов на диске (models.ResponseCache), задаётся ключом --cache.
+# Закрытые месяцы больше не запрашиваются, с --offline сеть не трогаем вообще:
+# ответы отдаются из кэша с полной скоростью, удобно гонять и профилировать разбор.
+cache = None
 
-async def fetch(url, session, qid):
+# Окно запросов в полёте (до limit) подбирается на ходу: растёт, пока ответы
+# быстрые, и уменьшается вдвое на 429, 5xx и таймаутах. False - всегда limit.
+adaptive = True
+
+# Плейсхолдер параметров драйвера базы: у psycopg2 это %s, у sqlite3 - ?
+mark = '%s'
+
+
+async def fetch(label, client, qid):
     '''
-    Принимаем URL, асинхронный объект сессии и wd-значение,
-    возвращаем его назад + то, что прислал нам сервер в ответ.
-    Обычный асинхронный таск без наворотов.
+    Принимаем название статьи, общий клиент с пулом соединений и wd-значение,
+    возвращаем его назад + (статья, даты, просмотры) из ответа сервера.
+    Если периодов больше split, запросов несколько, ответы склеиваются.
+    Ответ разбирается прямо из байтов, берём только timestamp и views,
+    см. models.parse_pageviews(). Одинаковые статьи (после normalize_title)
+    Client качает один раз и отдаёт всем qid, которые на них ссылаются.
+    Повторы при 429, 5xx, таймаутах и битом JSON делает сам Client,
+    здесь остаётся только ошибка (FetchError), которую уже не удалось победить.
+    Части качаются независимо: на диапазон без данных (например, раньше
+    создания статьи) API отвечает 404, такая часть просто пустая.
+    Статья падает, только если упала часть не с 404 или 404 во всех частях.
     '''
 
-    async with session.get(url) as response:
-        result = await response.text(encoding='utf-8')
+    urls = [URL.format(project=project, article=normalize_title(label), granularity=granularity,
+                       start=first, end=last)
+            for first, last in split_periods(periods, split)]
 
-        try:
-            result_json = orjson.loads(result)
-        except Exception as e:
-            result_json = {'error': e}
+    results = await asyncio.gather(*(client.get_pageviews(url) for url in urls),
+                                   return_exceptions=True)
+    parts = []
+    for result in results:
+        if isinstance(result, FetchError) and result.status == 404: continue
+        if isinstance(result, FetchError): return (qid, result)
+        if isinstance(result, BaseException): raise result
+        parts.append(result)
+    if not parts:
+        return (qid, results[0])
 
-        return (qid, result_json)
+    article = next((part[0] for part in parts if part[0]), '')
+    dates = [date for part in parts for date in part[1]]
+    views = [count for part in parts for count in part[2]]
+    return (qid, (article, dates, views))
 
 
 
-async def run(queries):
+def dead_letter(queries, responses):
     '''
-    Основной блок, который собирает запросы в асинхронный пучок
-    и запускает очередь задач. Внимание, много ручных параметров.
-    Читайте внимательно комментарии.
+    Складываем упавшие запросы в таблицу qindex_failed, чтобы потом
+    перезапустить только их: python statistics.py replay
+    В режиме replay удачные запросы из этой таблицы удаляем.
+    Статья, которой нет (404), ошибкой не считается. Промах офлайн-кэша (CacheMiss)
+    не ошибка и не успех: запроса не было, строку не трогаем.
     '''
 
-    # Это главный URL-запрос к Wikimedia Stat API.
-    #
-    # 1. Параметр /en.wikipedia.org/ (6-й по счёту) ищет запросы в en-википедии,
-    #    если нужна русская, должно стоять /ru.wikipedia.org/
-    #
-    # 2. Параметр /monthly/ (10-й) означает, что мы запрашиваем данные по месяцам.
-    #    Если хотим по дням, то пишем /daily/
-    #
-    # 3. Два последних параметра это дата начала и дата конца временного промежутка
-    #    в формате ГГГГММДД. Если меняете их, то соответственно отредактируйте
-    #    константу MONTHS в строке 24 данного файла.
-    #
+    labels = dict(queries)
+    failed, succeeded = [], []
 
-    url = "https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/en.wikipedia.org/all-access/user/{}/monthly/20150701/20210701"
+    for qid, result in responses:
+        if isinstance(result, CacheMiss): continue
+        if isinstance(result, FetchError) and result.status != 404:
+            failed.append((str(qid), labels[qid], str(result)))
+        else:
+            succeeded.append((str(qid),))
 
-    tasks = []
+    cur.executemany(
+        f"INSERT INTO qindex_failed (qid, label, error) VALUES ({mark}, {mark}, {mark}) "
+        "ON CONFLICT (qid) DO UPDATE SET error = EXCLUDED.error, "
+        "attempts = qindex_failed.attempts + 1;", failed)
+    if replay:
+        cur.executemany(f"DELETE FROM qindex_failed WHERE qid = {mark};", succeeded)
+    conn.commit()
 
-    # Fetch all responses within one Client session,
-    # keep connection alive for all requests.
 
-    global limit
-    connector = aiohttp.TCPConnector(limit_per_host = limit if limit <= 190 else 190)
 
+def read_qindex(cur, limit, after=None, until=None, table='qindex', mark='%s', key='qid'):
+    '''
+    Отдаём qindex пачками по limit строк, по порядку key (обычно qid).
+    Каждая пачка начинается сразу после последнего key предыдущей (keyset),
+    а не с OFFSET, поэтому последние страницы стоят столько же, сколько первые:
+    база идёт по индексу key, а не пересчитывает миллионы пропущенных строк.
+    after - с какого key (не включая) начать, until - на каком закончить (включая).
+    mark - плейсхолдер параметров драйвера, у psycopg2 это %s.
+    Отдаём пары (key последней строки, [(qid, label), ...]).
+    '''
+
+    while True:
+        where = []
+        params = []
+        if after is not None:
+            where.append(f'{key} > {mark}')
+            params.append(after)
+        if until is not None:
+            where.append(f'{key} <= {mark}')
+            params.append(until)
+        where = ('WHERE ' + ' AND '.join(where) + ' ') if where else ''
+
+        cur.execute(f'SELECT qid, label, {key} FROM {table} {where}ORDER BY {key} LIMIT {mark};',
+                    (*params, limit))
+        rows = cur.fetchall()
+        if not rows: break
+
+        after = rows[-1][2]
+        yield after, [row[:2] for row in rows]
+
+
+
+def csv_lines(responses):
+    '''
+    Эта функция разбирает ответ сервера на составляющие,
+    и превращает древовидную запись в табличную: строку CSV на каждую статью,
+    значения стоят в колонках своих периодов, пропуски пустые.
+    '''
+
+    for qid, result in responses:
+        if isinstance(result, FetchError) or not result[2]: continue
+
+        article, dates, views = result
+
+        head = '","'.join([str(qid), article])
+        tail ='","'.join(map(str, align(periods, dates, views)))
+        yield f'"{head}","{tail}"\n'
+
+
+
+async def write_csv(batches, path):
+    '''
+    Отдельный писатель: держит файл результата открытым с большим буфером
+    и пишет пачки строк из очереди batches, пока сеть качает следующие.
+    Вместе со строками пачки в очереди лежит future: когда пачка легла
+    на диск (fsync), в него кладём размер файла - это нужно чекпоинту.
+    None в очереди - всё, закрываемся.
+    '''
+
+    global global_counter
+
+    loop = asyncio.get_running_loop()
+
+    with open(path, 'a', buffering=1024 * 1024) as f:
+        while True:
+            batch = await batches.get()
+            if batch is None: break
+
+            lines, synced = batch
+            f.writelines(lines)
+            global_counter += len(lines)
+            metrics.inc('rows_total', len(lines), table='csv')
+
+            # Пачка должна лечь на диск раньше, чем чекпоинт скажет, что она записана.
+            f.flush()
+            with metrics.timer('fsync_seconds'):
+                await loop.run_in_executor(None, os.fsync, f.fileno())
+            synced.set_result(f.tell())
+
+
+
+async def show_progress(client, every=1):
+    '''
+    Строка прогресса обновляется по таймеру, а не на каждую запись.
+    У адаптивного клиента показываем ещё окно - сколько запросов сейчас можно держать в полёте.
+    '''
+
+    while True:
+        print('\r',
+            f'Прошло {time.strftime("%H:%M:%S", time.gmtime(time.time()-global_time))}, ',
+            f'записано строк {global_counter}, последний qid {after}',
+            f', окно {client.window:.0f}  ' if client.adaptive else '', end='', sep='')
+        await asyncio.sleep(every)
+
+
+
+def prepare_output(path):
+    '''
+    Если файла нет, то создадим, или если он есть, но пустой, - запишем туда заголовок CSV-таблицы.
+    Если файл есть, но колонки в нём другие, дописывать нельзя - строки съедут.
+    '''
+
+    header = '"qid","article",' + ','.join(f'"{period_label(period, granularity)}"'
+                                           for period in periods) + '\n'
+
+    if not os.path.exists(path) or (os.path.exists(path) and not os.path.getsize(path)):
+        with open(path, 'w') as f:
+            f.write(header)
+        return
+
+    with open(path, 'r') as f:
+        if f.readline() != header:
+            sys.exit(f'В {path} другие колонки, укажите другой файл результата')
+
+
+
+async def run(first, last, table, on_batch, window, key='qid'):
+    '''
+    Основной блок. Читаем qindex пачками и держим в полёте до window пачек сразу;
+    готовые пачки по порядку уходят писателю через очередь с ограниченным
+    размером: если диск не успевает, новые пачки не запускаются (backpressure).
+    Внимание, много ручных параметров. Читайте внимательно комментарии.
+    '''
+
+    # Fetch all responses within one Client session,
+    # keep connection alive for all requests.
+    #
     # Тут мы объявляем сессию с заголовком Api-User-Agent.
     # Пожалуйста, отредактируйте это значение в связи со своими
     # нуждами. Они просят тип проекта и адрес для обратной связи.
-    # Значение в строке 82: впишите туда ваши данные между 2-х апострофов.
+    # Значение чуть ниже: впишите туда ваши данные между 2-х апострофов.
+    #
+    # rate - сколько запросов в секунду мы себе позволяем, API просит не больше 100.
+
+    batches = asyncio.Queue(maxsize=window)
+    in_flight = asyncio.Semaphore(window)
+    writer = asyncio.ensure_future(write_csv(batches, output))
+
+    async def run_batch(last_key, labels, previous):
+        global after
+
+        try:
+            with metrics.timer('batch_fetch_seconds'):
+                responses = await asyncio.gather(*(fetch(item[1], client, item[0])
+                                                   for item in labels))
+            if previous is not None:
+                await previous          # пачки пишем строго по порядку
+
+            synced = asyncio.get_running_loop().create_future()
+            await batches.put((list(csv_lines(responses)), synced))
+            await synced
+
+            with metrics.timer('sql_seconds', statement='dead_letter'):
+                dead_letter(labels, responses)
 
-    async with aiohttp.ClientSession(connector=connector,
-                                     headers={'Api-User-Agent' :
-                                              'Scientific project (trankov@gmail.com)'},
-                                     ) as session:
-        for item in queries:
-            task = asyncio.ensure_future(fetch(url.format(item[1]), session, item[0]))
-            tasks.append(task)
+            after = last_key
+            if on_batch is not None:
+                on_batch(after)
+        finally:
+            in_flight.release()
 
-        responses = await asyncio.gather(*tasks)
-        # you now have all response bodies in this variable
+    async with Client(limit=limit if limit <= 190 else 190, rate=rate,
+                      headers={'Api-User-Agent' :
+                               'Scientific project (trankov@gmail.com)'},
+                      cache=cache, adaptive=adaptive) as client:
 
-        write_csv(responses)
+        progress = asyncio.ensure_future(show_progress(client))
 
+        # Читаем отдельным курсором, основной занят записью в qindex_failed.
+        reader = conn.cursor()
+        previous = None
+
+        try:
+            for last_key, labels in read_qindex(reader, limit, first, last, table=table, mark=mark, key=key):
+                await in_flight.acquire()
+                if previous is not None and previous.done():
+                    previous.result()   # упавшая пачка останавливает всё
+                previous = asyncio.ensure_future(run_batch(last_key, labels, previous))
 
-def write_csv(responses):
+            if previous is not None:
+                await previous
+        finally:
+            reader.close()
+            await batches.put(None)
+            await writer
+            progress.cancel()
+
+
+
+def harvest(first, last, table='qindex', on_batch=None, window=3, key='qid'):
     '''
-    Эта функция разбирает ответ сервера на составляющие,
-    и превращает древовидную запись в табличную. Файл с выходом
-    статистики указывается вручную, внимательно читайте
-    комментарии в коде!
+    Качаем всё от key first (не включая) до last (включая) пачками по limit.
+    После каждой записанной пачки зовём on_batch(последний key), если он есть.
+    '''
+
+    asyncio.run(run(first, last, table, on_batch, window, key))
+
+
+
+# Приоритетный проход: сначала самые популярные статьи. Популярность берём
+# из выгрузки Wikidata с числом сайтлинков (rawsrc/wikipedia.csv, см.
+# models.sitelink_counts). Таблица qindex_priority строится один раз,
+# ранг 1 - самый популярный, прерванный проход оставляет самое ценное.
+
+def plan_priority(path):
+    '''
+    Заполняем qindex_priority (rank, qid, label) всеми строками qindex
+    в порядке убывания числа сайтлинков, статьи без сайтлинков в дампе
+    идут следом по порядку qid. Если таблица уже есть, ничего не делаем.
+    '''
+
+    cur.execute("CREATE TABLE IF NOT EXISTS qindex_priority "
+                "(rank INTEGER PRIMARY KEY, qid TEXT NOT NULL, label TEXT NOT NULL);")
+    cur.execute("SELECT count(*) FROM qindex_priority;")
+    if cur.fetchone()[0]:
+        return
+
+    counts = sitelink_counts(path)
+    ranked = sorted(counts, key=lambda qid: (-counts[qid], qid))
+
+    # qid в qindex может быть и числом, и строкой вида Q7243
+    cur.execute("CREATE TEMPORARY TABLE ranked (rank INTEGER, qid TEXT);")
+    cur.executemany("INSERT INTO ranked VALUES (%s, %s);",
+                    [(rank, str(qid)) for rank, qid in enumerate(ranked, 1)])
+    cur.execute("INSERT INTO qindex_priority (rank, qid, label) "
+                "SELECT row_number() OVER (ORDER BY ranked.rank NULLS LAST, qindex.qid), "
+                "qindex.qid, qindex.label FROM qindex "
+                "LEFT JOIN ranked ON ltrim(qindex.qid::text, 'Q') = ranked.qid;")
+    cur.execute("DROP TABLE ranked;")
+    conn.commit()
+    cur.execute("SELECT count(*) FROM qindex_priority;")
+    print(f'Статей в приоритетном проходе: {cur.fetchone()[0]}')
+
+
+
+# Режим нескольких воркеров (на одной или на разных машинах с общей базой).
+# Таблица qindex_claims - это журнал диапазонов qid: координатор один раз режет
+# qindex на диапазоны (python statistics.py plan), воркеры атомарно забирают
+# свободный диапазон, пока качают - отмечаются (heartbeat) и пишут, до какого
+# qid дошли. Если воркер умер и давно не отмечался, его диапазон забирает
+# другой и продолжает с того же места.
+
+class ClaimLost(Exception):
+    '''
+    Наш диапазон забрал другой воркер, пока мы долго не отмечались.
     '''
 
-    global global_counter
-    global global_time
-    global offset
 
-    global output
 
-    with open(output, 'a') as f:
+def plan_claims(size):
+    '''
+    Режем qindex на диапазоны по size строк и записываем их в qindex_claims.
+    Если журнал уже есть, ничего не делаем.
+    '''
 
-        for element in responses:
-            if 'items' not in element[1]: continue
+    cur.execute("CREATE TABLE IF NOT EXISTS qindex_claims "
+                "(range_id SERIAL PRIMARY KEY, first_qid TEXT, last_qid TEXT, "
+                "status TEXT NOT NULL DEFAULT 'free', worker TEXT, "
+                "heartbeat TIMESTAMPTZ, progress TEXT);")
+    cur.execute("SELECT count(*) FROM qindex_claims;")
+    if cur.fetchone()[0]:
+        print('Журнал qindex_claims уже заполнен')
+        return
 
-            articles = element[1]['items']
+    cur.execute("SELECT qid FROM (SELECT qid, row_number() OVER (ORDER BY qid) AS rn "
+                "FROM qindex) numbered WHERE rn %% %s = 0 ORDER BY qid;", (size,))
+    bounds = [None] + [row[0] for row in cur.fetchall()] + [None]
 
-            head = '","'.join([str(element[0]), articles[0]['article']])
-            tail ='","'.join(str(article['views']) for article in articles)
-            body = f'"{head}","{tail}"'
+    cur.executemany("INSERT INTO qindex_claims (first_qid, last_qid) VALUES (%s, %s);",
+                    list(zip(bounds[:-1], bounds[1:])))
+    conn.commit()
+    print(f'Диапазонов в журнале: {len(bounds) - 1}')
 
-            f.write(body + '\n')
-            global_counter += 1
-            print('\r',
-                f'Прошло {time.strftime("%H:%M:%S", time.gmtime(time.time()-global_time))}, ',
-                f'записано строк {global_counter}, offset {offset}', end='', sep='')
+
+
+def claim(worker, stale):
+    '''
+    Забираем первый свободный диапазон или тот, чей воркер не отмечался
+    дольше stale секунд. SKIP LOCKED не даёт двум воркерам взять один и тот же.
+    Возвращаем (range_id, first_qid, last_qid, progress) или None, если всё готово.
+    '''
+
+    cur.execute("UPDATE qindex_claims SET status = 'claimed', worker = %s, heartbeat = now() "
+                "WHERE range_id = (SELECT range_id FROM qindex_claims "
+                "WHERE status = 'free' OR (status = 'claimed' "
+                "AND heartbeat < now() - %s * interval '1 second') "
+                "ORDER BY range_id LIMIT 1 FOR UPDATE SKIP LOCKED) "
+                "RETURNING range_id, first_qid, last_qid, progress;", (worker, stale))
+    claimed = cur.fetchone()
+    conn.commit()
+    return claimed
+
+
+
+def heartbeat(range_id, worker, progress):
+    '''
+    Отмечаемся и запоминаем, до какого qid дошли.
+    '''
+
+    cur.execute("UPDATE qindex_claims SET heartbeat = now(), progress = %s "
+                "WHERE range_id = %s AND worker = %s AND status = 'claimed';",
+                (str(progress), range_id, worker))
+    lost = not cur.rowcount
+    conn.commit()
+    if lost:
+        raise ClaimLost(range_id)
+
+
+
+def release(range_id, worker, status):
+    '''
+    Отдаём диапазон: status 'done' - готов, 'free' - пусть доделает кто-нибудь ещё.
+    '''
+
+    cur.execute("UPDATE qindex_claims SET status = %s, heartbeat = now() "
+                "WHERE range_id = %s AND worker = %s;", (status, range_id, worker))
+    conn.commit()
+
+
+
+def work(worker, settings, stale=600):
+    '''
+    Один воркер: своё подключение к базе и свой файл с результатом,
+    забирает диапазоны из журнала, пока они не кончатся.
+    Все настройки приходят в settings, а не из глобальных переменных __main__:
+    при запуске процессов через spawn (macOS, Windows) модуль импортируется
+    заново и того, что задано под if __name__ == "__main__", в нём нет.
+    '''
+
+    global conn, cur, output, limit, rate, cache, adaptive
+    global project, granularity, split, periods, replay, after, global_counter, global_time
+
+    project, granularity, split = settings['project'], settings['granularity'], settings['split']
+    periods = plan_periods(settings['start'], settings['end'], granularity)
+    limit, rate, cache, adaptive = settings['limit'], settings['rate'], settings['cache'], settings['adaptive']
+    replay, after, global_counter, global_time = False, None, 0, time.time()
+
+    conn = psycopg2.connect(settings['dsn'])
+    cur = conn.cursor()
+
+    root, ext = os.path.splitext(settings['output'])
+    output = f'{root}-{worker}{ext}'
+    prepare_output(output)
+
+    while True:
+        claimed = claim(worker, stale)
+        if claimed is None: break
+
+        range_id, first, last, progress = claimed
+        try:
+            harvest(progress or first, last,
+                    on_batch=lambda qid: heartbeat(range_id, worker, qid))
+        except ClaimLost:
+            continue
+        except BaseException:
+            release(range_id, worker, 'free')
+            raise
+        release(range_id, worker, 'done')
+
+    cur.close()
+    conn.close()
 
 
 
@@ -129,54 +496,132 @@ if __name__ == "__main__":
     global_counter = 0
     global_time = time.time()
 
-    # С какой строки в базе данных начать. Полезно, если сеть не выдержала,
-    # а мы не хотим стартовать с самого начала. Для этого мы выводим на экран
-    # информацию о каждой записанной строке, её можно затем скопировать сюда
-    offset = 0
+    # С какого qid в базе данных начать (не включая его). Полезно, если сеть
+    # не выдержала, а мы не хотим стартовать с самого начала. Для этого мы
+    # выводим на экран последний записанный qid, его можно затем скопировать сюда
+    after = None
 
     # Количество записей за 1 запрос. Есть в
     limit = 190
 
-    # Захардкодил, чтобы можно было устанавливать offset как начальную строку,
-    # total как конечную, и limit как количество строк за один проход. Технически
-    # это значение легко можно получить автоматически из базы. Но если разносить
-    # по разным машинам, то так руками поправить вполне удобно.
-    total = 9114545
+    # Не больше стольких запросов в секунду, с учётом повторов.
+    # Воркеры на одной машине делят это ограничение поровну.
+    rate = 90
+
+    # Режимы запуска:
+    #   python statistics.py              - один процесс, от after до until
+    #   python statistics.py replay       - перезапросить только то, что упало в прошлый раз
+    #   python statistics.py priority     - сначала самые популярные статьи, см. plan_priority()
+    #   python statistics.py plan [N]     - нарезать журнал qindex_claims по N строк
+    #   python statistics.py worker [N]   - N воркеров на этой машине работают по журналу
+    # Диапазон дат и вики задаются ключами, например:
+    #   python statistics.py --start 20150701 --end 20260901 --granularity daily
+    # Кэш ответов: --cache ~/wikidata/cache, только из кэша: --cache ... --offline
+    # Счётчики и времена: --metrics run.prom (kill -USR1 <pid> - выгрузить прямо сейчас)
+    parser = argparse.ArgumentParser(description='Pageviews for qindex articles')
+    parser.add_argument('mode', nargs='?', choices=('run', 'replay', 'priority', 'plan', 'worker'), default='run')
+    parser.add_argument('count', nargs='?', type=int, help='rows per range for plan, processes for worker')
+    parser.add_argument('--project', default=project)
+    parser.add_argument('--granularity', choices=('monthly', 'daily'), default=granularity)
+    parser.add_argument('--start', default=start, help='YYYYMMDD, included')
+    parser.add_argument('--end', default=end, help='YYYYMMDD, included')
+    parser.add_argument('--split', type=int, default=split, help='max periods per request')
+    parser.add_argument('--output', help='result CSV file')
+    parser.add_argument('--cache', help='directory to keep responses in')
+    parser.add_argument('--offline', action='store_true', help='answer from --cache only')
+    parser.add_argument('--metrics', help='file for counters and timings: .json or .prom, '
+                                          'written at exit and on SIGUSR1')
+    parser.add_argument('--sitelinks', help='popularity CSV for priority mode',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             '..', 'rawsrc', 'wikipedia.csv'))
+    args = parser.parse_args()
+
+    mode = args.mode
+    replay = mode == 'replay'
+    priority = mode == 'priority'
+
+    project, granularity, split = args.project, args.granularity, args.split
+    start, end = args.start, args.end
+    periods = plan_periods(start, end, granularity)
+    if args.cache:
+        cache = ResponseCache(args.cache, offline=args.offline)
+    if args.metrics:
+        metrics.install(args.metrics)
+
+    # На каком qid закончить (включая его), None - до конца таблицы.
+    until = None
 
     # Тут законнектите к вашей базе. По идее все такие
     # модули используют один синтаксис, а sql там не сложный.
 
-    conn = psycopg2.connect("dbname=wikidata user=user password=password port=5432")
+    DSN = "dbname=wikidata user=user password=password port=5432"
+    conn = psycopg2.connect(DSN)
     cur = conn.cursor()
 
+    # Keyset-чтение в read_qindex() держится на индексе по qid.
+    cur.execute("CREATE INDEX IF NOT EXISTS qindex_qid ON qindex (qid);")
+
+    # Таблица для упавших запросов (dead letter), см. dead_letter()
+    cur.execute("CREATE TABLE IF NOT EXISTS qindex_failed "
+                "(qid TEXT PRIMARY KEY, label TEXT NOT NULL, error TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 1);")
+    conn.commit()
+
     # Пропишите свой путь к файлу с результатом.
     # output = '...'
-    # Сейчас он в домашнем каталоге ищет /wikidata/en-visits.csv,
+    # Сейчас он в домашнем каталоге ищет /wikidata/<вики>-visits.csv
+    # (en-visits.csv для en.wikipedia.org, en.wikiquote.org-visits.csv и т.д.),
     # если такого каталога нет, он упадёт с File Not Found Error.
-    output = os.path.expanduser ('~/wikidata/en-visits.csv')
-
-    # Если файла нет, то создадим, или если он есть, но пустой, - запишем туда заголовок CSV-таблицы.
-    if not os.path.exists(output) or (os.path.exists(output) and not os.path.getsize(output)):
-        with open(output, 'w') as f:
-            f.write('"qid","article",' + MONTHS + '\n')
-
-
-    complete = False
-    while not complete:
-
-        complete = (offset + limit) >= total
-
-        cur.execute("SELECT qid, label FROM qindex LIMIT %s OFFSET %s;", (limit, offset))
-        labels = cur.fetchall()
-
-        loop = asyncio.get_event_loop()
-        future = asyncio.ensure_future(run([i for i in labels]))
-        loop.run_until_complete(future)
-
-        offset += limit
-
-    cur.close()
-    conn.close()
+    # Воркеры пишут каждый в свой <вики>-visits-<воркер>.csv рядом с ним.
+    wiki = project[:-len('.wikipedia.org')] if project.endswith('.wikipedia.org') else project
+    output = args.output or os.path.expanduser (f'~/wikidata/{wiki}-visits.csv')
+
+    if mode == 'plan':
+        plan_claims(args.count or 100000)
+
+    elif mode == 'worker':
+        cur.close()
+        conn.close()
+
+        # Ограничение rate общее для машины: делим его между воркерами.
+        workers = args.count or 1
+        settings = {'dsn': DSN, 'output': output, 'limit': limit,
+                    'rate': rate / workers if rate else None, 'cache': cache, 'adaptive': adaptive,
+                    'project': project, 'granularity': granularity, 'split': split,
+                    'start': start, 'end': end}
+        processes = [Process(target=work, args=(f'{socket.gethostname()}-{os.getpid()}-{n}', settings))
+                     for n in range(workers)]
+        [process.start() for process in processes]
+        [process.join() for process in processes]
+
+    else:
+        prepare_output(output)
+
+        # Чекпоинт лежит рядом с файлом результата: последний записанный qid,
+        # сколько строк записано и размер файла на тот момент. Если скрипт упал,
+        # он сам продолжит с этого qid, а недописанный хвост файла обрежет.
+        suffix = {'replay': '.replay', 'priority': '.priority'}.get(mode, '')
+        checkpoint = Checkpoint(output + suffix + '.checkpoint.json')
+        state = checkpoint.load()
+        if state and after is None:
+            after = state['after']
+            global_counter = state['rows']
+            with open(output, 'r+') as f:
+                f.truncate(state['position'])
+            print(f'Продолжаем после {"ранга" if priority else "qid"} {after}')
+
+        if priority:
+            plan_priority(args.sitelinks)
+        table = {'replay': 'qindex_failed', 'priority': 'qindex_priority'}.get(mode, 'qindex')
+
+        harvest(after, until, table=table, key='rank' if priority else 'qid',
+                on_batch=lambda key: checkpoint.save(after=key, rows=global_counter,
+                                                     position=os.path.getsize(output)))
+        checkpoint.clear()
+
+    if not conn.closed:
+        cur.close()
+        conn.close()
 
     print()
     print('-'*80)
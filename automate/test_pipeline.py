@@ -0,0 +1,355 @@
+# Tests for the pipeline parts which are easy to break without noticing:
+# keyset paging, resume keys, checkpoints, retries and shared downloads.
+#
+# python -m pytest -q automate
+
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from models import Dataset, Client, Checkpoint, FetchError, plan_periods, align
+from getstats import Watermark
+
+
+
+def make_dataset(path, qids) -> Dataset:
+    """
+    Dataset over a fresh database with a writers row for every qid,
+    repeated qids are writers with several articles.
+    """
+
+    ds = Dataset(path)
+    ds.con.executemany(
+            'INSERT INTO writers (writer_qid, writer, birthplace_qid, birthplace, geo_lat, geo_lon, '
+            'ethnicity_qid, ethnicity, language_qid, language, article) '
+            "VALUES (?, 'W', 0, '', 0, 0, 0, '', 0, '', ?)",
+            ((qid, f'https://ru.wikipedia.org/wiki/A{n}') for n, qid in enumerate(qids)))
+    ds.con.commit()
+    ds.count = len(qids)
+    return ds
+
+
+
+def test_keyset_paging_latency_is_flat():
+    pytest.importorskip('psycopg2')
+    from statistics import read_qindex
+
+    rows, limit = 200000, 190
+
+    con = sqlite3.connect(':memory:')
+    con.execute('CREATE TABLE qindex (qid INTEGER PRIMARY KEY, label TEXT NOT NULL)')
+    con.executemany('INSERT INTO qindex VALUES (?, ?)',
+                    ((qid, f'Article_{qid}') for qid in range(1, rows * 2, 2)))
+    cur = con.cursor()
+
+    def offset_pages():
+        for offset in range(0, rows, limit):
+            yield offset + limit, cur.execute('SELECT qid, label FROM qindex LIMIT ? OFFSET ?',
+                                              (limit, offset)).fetchall()
+
+    def latencies(pages):
+        result, seen = [], []
+        while True:
+            start = time.perf_counter()
+            page = next(pages, None)
+            if page is None: break
+            result.append(time.perf_counter() - start)
+            seen.extend(qid for qid, _ in page[1])
+        return result, seen
+
+    keyset, seen = latencies(read_qindex(cur, limit, mark='?'))
+    offset, _ = latencies(offset_pages())
+
+    assert seen == list(range(1, rows * 2, 2))
+
+    def median(values):
+        return sorted(values)[len(values) // 2]
+
+    first, last = median(keyset[:20]), median(keyset[-20:])
+    assert last < first * 3 + .0005
+    # The same table paged with OFFSET does grow, so the check above can fail
+    assert last * 3 < median(offset[-20:])
+
+
+
+def test_keyset_chunks_never_split_a_writer(tmp_path):
+    qids = [1, 2, 2, 2, 3, 4, 4, 5, 6, 6, 6, 6, 7]
+    ds = make_dataset(tmp_path / 'w.sqlite3', qids)
+    ds.fields = 'writer_qid, article'
+    ds.limit = 3
+    ds.keyset = True
+
+    chunks = list(iter(ds.iter_chunk, None))
+    assert [row['writer_qid'] for chunk in chunks for row in chunk] == qids
+    assert all(len(chunk) >= ds.limit for chunk in chunks[:-1])
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert previous[-1]['writer_qid'] < chunk[0]['writer_qid']
+
+    ds.keyset, ds.offset = False, 0
+    offset_rows = [row for chunk in iter(ds.iter_chunk, None) for row in chunk]
+    assert offset_rows == [row for chunk in chunks for row in chunk]
+    ds.close()
+
+
+
+def test_keyset_resumes_after_the_token(tmp_path):
+    ds = make_dataset(tmp_path / 'w.sqlite3', [1, 2, 2, 3, 4, 4, 5])
+    ds.fields = 'writer_qid'
+    ds.limit = 2
+    ds.keyset = True
+
+    ds.iter_chunk()
+    after = ds.after
+    rest = [row['writer_qid'] for chunk in iter(ds.iter_chunk, None) for row in chunk]
+
+    ds.after = after
+    assert [row['writer_qid'] for chunk in iter(ds.iter_chunk, None) for row in chunk] == rest
+    assert rest and min(rest) > after
+    ds.close()
+
+
+
+def test_watermark_waits_for_every_row_before_the_key():
+    watermark = Watermark(10)
+    for key in (11, 11, 12, 13):
+        watermark.push(key)
+
+    watermark.done(12)
+    watermark.done(11)
+    assert watermark.key == 10
+
+    watermark.done(11)
+    assert watermark.key == 12
+
+    watermark.done(13)
+    assert watermark.key == 13
+
+
+
+def test_checkpoint_roundtrip(tmp_path):
+    checkpoint = Checkpoint(tmp_path / 'run.checkpoint.json')
+    assert checkpoint.load() == {}
+
+    checkpoint.save(after=42, done=100)
+    checkpoint.save(after=43, done=150)
+    assert checkpoint.load() == {'after': 43, 'done': 150}
+    assert [p.name for p in tmp_path.iterdir()] == ['run.checkpoint.json']
+
+    checkpoint.clear()
+    checkpoint.clear()
+    assert checkpoint.load() == {}
+
+
+
+def test_plan_periods_and_align():
+    assert plan_periods('20201115', '20210301') == [20201101, 20201201, 20210101, 20210201, 20210301]
+    assert plan_periods('20200227', '20200302', 'daily') == \
+           [20200227, 20200228, 20200229, 20200301, 20200302]
+    with pytest.raises(ValueError):
+        plan_periods('20200101', '20200201', 'weekly')
+
+    periods = plan_periods('20210101', '20210401')
+    assert align(periods, [20210201, 20210401, 20191201], [5, 7, 9]) == ['', 5, '', 7]
+    assert align(periods, [], [], gap=0) == [0, 0, 0, 0]
+
+
+
+class FakeResponse(object):
+
+    def __init__(self, status: int, body: bytes):
+        self.status = status
+        self.headers = {}
+        self._body = body
+
+    async def read(self):
+        return self._body
+
+    async def __aenter__(self):
+        await asyncio.sleep(.01)
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+
+class FakeSession(object):
+    """
+    Answers with the given statuses one by one, then with 200 only.
+    """
+
+    def __init__(self, *statuses, body: bytes = b'{"items": []}'):
+        self.statuses = list(statuses)
+        self.body = body
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+        status = self.statuses.pop(0) if self.statuses else 200
+        return FakeResponse(status, self.body if status == 200 else b'')
+
+
+
+def fake_client(*statuses, body: bytes = b'{"items": []}', **kwargs) -> Client:
+    client = Client(limit=4, backoff=0, **kwargs)
+    client._session = FakeSession(*statuses, body=body)
+    client._semaphore = asyncio.Semaphore(client.limit)
+    return client
+
+
+
+def test_client_retries_retryable_statuses():
+    async def run():
+        client = fake_client(503, 429)
+        assert await client.get_json('https://x/a') == {'items': []}
+        return client._session.urls
+
+    assert asyncio.run(run()) == ['https://x/a'] * 3
+
+
+
+def test_client_gives_up_on_other_statuses_and_after_retries():
+    async def run(retries, *statuses):
+        client = fake_client(*statuses, retries=retries)
+        with pytest.raises(FetchError) as error:
+            await client.get_json('https://x/a')
+        return error.value.status, len(client._session.urls)
+
+    assert asyncio.run(run(5, 404)) == (404, 1)
+    assert asyncio.run(run(2, 503, 503, 503)) == (503, 3)
+
+
+
+def test_client_shares_equal_requests():
+    async def run():
+        client = fake_client()
+        answers = await asyncio.gather(*(client.get_json(url) for url in
+                                         ('https://x/a', 'https://x/a', 'https://x/b', 'https://x/a')))
+        again = await client.get_json('https://x/b')
+        return client, answers, again
+
+    client, answers, again = asyncio.run(run())
+    assert answers == [{'items': []}] * 4 and again == {'items': []}
+    assert sorted(client._session.urls) == ['https://x/a', 'https://x/b']
+    assert client.coalesced == 3
+
+
+
+def test_split_range_keeps_parts_after_a_404(monkeypatch):
+    pytest.importorskip('psycopg2')
+    import statistics
+
+    monkeypatch.setattr(statistics, 'periods', plan_periods('20200101', '20200401'))
+    monkeypatch.setattr(statistics, 'split', 2)
+    body = b'{"items":[{"article":"A","timestamp":"2020030100","views":5},' + \
+           b'{"article":"A","timestamp":"2020040100","views":7}]}'
+
+    async def run(*statuses):
+        return (await statistics.fetch('A', fake_client(*statuses, body=body, retries=0), 1))[1]
+
+    # The first part predates the article
+    article, dates, views = asyncio.run(run(404, 200))
+    assert (article, list(dates), list(views)) == ('A', [20200301, 20200401], [5, 7])
+    assert align(statistics.periods, dates, views) == ['', '', 5, 7]
+
+    assert asyncio.run(run(404, 404)).status == 404
+    assert asyncio.run(run(404, 503)).status == 503
+
+
+
+def test_failed_sitelinks_hold_the_resume_key(tmp_path, monkeypatch):
+    import projects
+
+    async def run(failures):
+        ds = make_dataset(tmp_path / f'w{failures}.sqlite3', [1, 2, 3, 4])
+        ds.fields = 'writer_qid'
+        ds.limit = 2
+        ds.keyset = True
+        calls = []
+
+        async def fetch_sitelinks(client, qids, families):
+            calls.append(list(qids))
+            if len(calls) <= failures:
+                raise FetchError('HTTP 503', 'https://www.wikidata.org/', 503)
+            return [(qid, 'en.wikipedia.org', f'https://en.wikipedia.org/wiki/Q{qid}') for qid in qids]
+
+        monkeypatch.setattr(projects, 'fetch_sitelinks', fetch_sitelinks)
+        rows, watermark, keys = asyncio.Queue(), Watermark(), []
+        try:
+            await projects.produce_sitelinks(ds, None, rows, watermark, 1, ())
+        finally:
+            while not rows.empty():
+                item = rows.get_nowait()
+                if item is not None:
+                    watermark.done(item['writer_qid'])
+                    keys.append(watermark.key)
+            ds.close()
+        return calls, keys
+
+    calls, keys = asyncio.run(run(1))
+    assert calls == [[1, 2], [3, 4], [1, 2]]
+    # Rows of 3 and 4 are done first, the key waits for the retried 1 and 2
+    assert keys == [None, None, 1, 4]
+
+    # The retry fails too
+    with pytest.raises(FetchError):
+        asyncio.run(run(3))
+
+
+
+@pytest.mark.parametrize('storage', ['rows', 'series'])
+def test_totals_are_the_same_in_both_storages(tmp_path, storage):
+    ds = make_dataset(tmp_path / 'w.sqlite3', [1])
+    ds.storage = storage
+
+    def month(yearmonth, visits):
+        return {'writer_qid': 1, 'yearmonth': yearmonth, 'visits': visits}
+
+    # 2021.02 is a gap, 2021.04 was fetched with no views
+    ds.insert_stat([[month('2021.01', 4), month('2021.03', 8)]])
+    ds.insert_stat([[month('2021.04', 0), month('2021.01', 3)]])
+
+    assert tuple(ds.con.execute('SELECT total, average, months, last_month FROM writer_totals '
+                                'WHERE writer_qid = 1').fetchone()) == (11, 11 / 3, 3, 2021.04)
+    ds.close()
+
+
+
+def test_cache_keeps_closed_periods_after_the_publication_lag(tmp_path):
+    from datetime import datetime, timedelta
+    from models import ResponseCache
+
+    url = 'https://x/per-article/ru.wikipedia/all-access/user/A/{}/20200101/{}'
+    month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    since = (datetime.now() - month).total_seconds()
+    last = (month - timedelta(days=1)).replace(day=1).strftime('%Y%m%d')
+    yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y%m%d')
+
+    # Last month closed `since` seconds ago: published only once the lag is over
+    assert ResponseCache(tmp_path, lag=0).immutable(url.format('monthly', last))
+    assert not ResponseCache(tmp_path, lag=since + 3600).immutable(url.format('monthly', last))
+    assert not ResponseCache(tmp_path, lag=0).immutable(url.format('monthly', month.strftime('%Y%m%d')))
+
+    assert ResponseCache(tmp_path, lag=0).immutable(url.format('daily', yesterday))
+    assert not ResponseCache(tmp_path, lag=2 * 86400).immutable(url.format('daily', yesterday))
+    assert not ResponseCache(tmp_path).immutable('https://x/no/dates')
+
+
+
+def test_adaptive_limit_cuts_on_pushback_only():
+    from models import AdaptiveLimit
+
+    limit = AdaptiveLimit(90)
+    window = limit.window
+    for _ in range(50):
+        limit.observe(.05, failed=True)     # fast 5xx: no cut, no growth
+    assert limit.window == window
+
+    limit.observe(.05)
+    assert limit.window > window
+
+    window = limit.window
+    limit.observe(.05, congested=True)      # 429 or timeout
+    assert limit.window == window * limit.decrease